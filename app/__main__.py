@@ -1,5 +1,54 @@
-from app.main import app, socketio
+from argparse import ArgumentParser
+from statistics import median
+from typing import Any, List
+import subprocess
+import sys
+import os
+
+from app.main import create_app, socketio
+from app.config import Settings, get_settings
+import app.backup as app_backup
+
+
+# Runs in a fresh interpreter: import the server, build the app and wait for the welcome of the first client.
+STARTUP_PROBE = """
+from time import perf_counter
+started = perf_counter()
+from app.main import create_app, socketio
+client = socketio.test_client(create_app())
+assert client.is_connected() and client.get_received()[0]["name"] == "welcome"
+print(perf_counter() - started)
+"""
+
+
+def benchmark_startup(runs: int = 5) -> List[float]:
+    "Seconds from `import app.main` to the first accepted Socket.IO connection, one fresh process per run."
+
+    return [float(subprocess.run([sys.executable, '-c', STARTUP_PROBE], check=True,
+                                 capture_output=True, text=True).stdout.split()[-1])
+            for _ in range(runs)]
+
+
+def serving_process(settings: Settings) -> bool:
+    """False in the debug reloader's watcher process, which only restarts the server.
+    Background jobs started there would run next to the ones of the process that serves."""
+
+    return not settings.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
 
 
 if __name__ == '__main__':
-    socketio.run(app, host='127.0.0.1', port=9789, debug=True)
+    parser = ArgumentParser(prog='python -m app', description="Renale server.")
+    parser.add_argument('command', nargs='?', choices=['serve', 'bench-startup'], default='serve')
+    parser.add_argument('--runs', type=int, default=5, help="Processes to start for bench-startup.")
+    args: Any = parser.parse_args()
+
+    if args.command == 'bench-startup':
+        timings = benchmark_startup(args.runs)
+        print(f"import to first connection: median {median(timings) * 1000:.1f} ms, "
+              f"min {min(timings) * 1000:.1f} ms over {len(timings)} runs")
+    else:
+        app = create_app()
+        settings = get_settings()
+        if settings.backup_interval and serving_process(settings):
+            app_backup.start_scheduler(settings.backup_interval)
+        socketio.run(app, host=settings.host, port=settings.port, debug=settings.debug)
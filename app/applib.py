@@ -1,10 +1,11 @@
 from typing import Any, Dict, List, Union
 from time import time as unixtime
 from random import randint
-from pathlib import Path
+import secrets
+import string
 
 
-__all__ = ["Json", "JsonD", "random_id", "logf"]
+__all__ = ["Json", "JsonD", "random_id", "random_token", "logf"]
 
 
 JsonD = Dict[str, Any]
@@ -15,12 +16,19 @@ def random_id() -> int:
     return randint(0, 999_999_999)
 
 
+def random_token(length: int = 128) -> str:
+    return "".join(secrets.choice(string.ascii_letters + string.digits) for _ in range(length))
+
+
 def logf(err: str | Exception, warn: int = 0):
     """Log.
     `txt` - error text.
     `warn` - warning level (0 - info, 1 - warning, >1 - error).
     """
 
+    # app.config imports this module, the settings are looked up when logging
+    from app.config import get_settings
+
     warn_level = 'E' if warn > 1 else 'W' if warn else 'I'
-    with open(Path(__file__).parent.parent/'log.txt', 'a') as f:
+    with open(get_settings().data_dir/'log.txt', 'a') as f:
         f.write(f'[{warn_level}]-{str(unixtime())}:\n{err}\n\n')
@@ -0,0 +1,196 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+from argparse import ArgumentParser
+from threading import Lock, Thread
+from time import time as unixtime
+from hashlib import sha256
+from pathlib import Path
+import os
+
+from app.applib import JsonD
+from app.config import get_settings
+import app.database as app_database
+
+
+__all__ = ["blob_path", "write_chunk", "expire_uploads", "CHUNK_SIZE"]
+
+
+# Size of the pieces copied from the request body to disk, a whole chunk is never held in memory.
+CHUNK_SIZE: int = 64 * 1024
+
+Reader = Callable[[int], bytes]
+
+_upload_locks_lock = Lock()
+_upload_locks: Dict[str, Lock] = {}
+_last_expiry: float = 0
+
+
+def _upload_lock(upload_id: str) -> Lock:
+    with _upload_locks_lock:
+        return _upload_locks.setdefault(upload_id, Lock())
+
+
+def _drop_upload_lock(upload_id: str) -> None:
+    with _upload_locks_lock:
+        _upload_locks.pop(upload_id, None)
+
+
+def attachments_dir() -> Path:
+    return get_settings().data_dir/'attachments'
+
+
+def part_path(upload_id: str, directory: Optional[Path] = None) -> Path:
+    return (directory or attachments_dir())/'uploads'/f'{upload_id}.part'
+
+
+def blob_path(digest: str, directory: Optional[Path] = None) -> Path:
+    "Content addressed location of a stored file, `objects/ab/abcdef...`."
+
+    return (directory or attachments_dir())/'objects'/digest[:2]/digest
+
+
+# region STORAGE
+def append_stream(path: Path, offset: int, read: Reader, limit: int) -> int:
+    """Copy `read` into `path` starting at `offset` until it is exhausted.
+    Returns the new file size, or -1 if the data would go past `limit`."""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'r+b' if path.exists() else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        position = offset
+        while piece := read(CHUNK_SIZE):
+            position += len(piece)
+            if position > limit:
+                f.truncate(offset)
+                return -1
+            f.write(piece)
+    return position
+
+
+def store_blob(part: Path, directory: Optional[Path] = None) -> str:
+    "Move a finished upload into the object store and return its SHA-256. Identical files are kept once."
+
+    digest = sha256()
+    with open(part, 'rb') as f:
+        while piece := f.read(1024 * 1024):
+            digest.update(piece)
+    hexdigest = digest.hexdigest()
+
+    target = blob_path(hexdigest, directory)
+    if target.exists():
+        part.unlink()
+    else:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(part, target)
+    return hexdigest
+
+
+# endregion
+# region UPLOADS
+def write_chunk(upload_id: str, user_id: int, offset: int, read: Reader) -> Tuple[int, str | JsonD]:
+    """Write one chunk of an upload and return (status code, error text or upload state).
+    `offset` has to equal the number of bytes already received, so a client that lost
+    a chunk asks for the upload state and resumes from `received`. The last chunk
+    returns the created attachment instead of the upload state.
+    """
+
+    with _upload_lock(upload_id):
+        upload = app_database.get_upload(upload_id)
+        if not upload:
+            _drop_upload_lock(upload_id)
+            return (404, "Upload not found")
+        if upload["user_id"] != user_id:
+            return (404, "Upload not found")
+        if offset != upload["received"]:
+            return (409, {"upload_id": upload_id, "size": upload["size"], "received": upload["received"]})
+
+        part = part_path(upload_id)
+        received = append_stream(part, offset, read, upload["size"])
+        if received < 0:
+            return (413, "Chunk goes past the declared upload size")
+
+        if received < upload["size"]:
+            app_database.set_upload_received(upload_id, received)
+            return (200, {"upload_id": upload_id, "size": upload["size"], "received": received})
+
+        attachment = app_database.finish_upload(upload_id, store_blob(part))
+
+    _drop_upload_lock(upload_id)
+    if not attachment:
+        return (500, "Error saving attachment")
+    return (201, attachment)
+
+
+def expire_uploads(force: bool = False) -> int:
+    """Forget uploads started more than `upload_ttl` seconds ago and delete their partial files.
+    Runs at most once a minute unless `force`. Returns the number of removed uploads."""
+
+    global _last_expiry
+
+    now = unixtime()
+    if not force and now - _last_expiry < 60:
+        return 0
+    _last_expiry = now
+
+    removed = 0
+    for upload_id in app_database.get_expired_uploads(now - get_settings().upload_ttl):
+        # The row is deleted under the upload lock, so a chunk being written right now
+        # finishes (or turns into an attachment) first and the next one gets a 404.
+        with _upload_lock(upload_id):
+            if app_database.delete_upload(upload_id):
+                part_path(upload_id).unlink(missing_ok=True)
+                removed += 1
+        _drop_upload_lock(upload_id)
+    return removed
+
+
+# endregion
+# region TOOLS
+def benchmark(uploads: int = 16, size: int = 8 * 1024 * 1024, threads: int = 8) -> float:
+    """Upload `uploads` files of `size` bytes from `threads` writers in 1 MiB chunks
+    straight through the storage layer and return MiB per second."""
+
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+    from io import BytesIO
+
+    chunk = os.urandom(1024 * 1024)
+    with TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+
+        def uploader(n: int) -> None:
+            for i in range(n, uploads, threads):
+                part = part_path(f'bench-{i}', directory)
+                offset = 0
+                while offset < size:
+                    # every file gets a unique first chunk so dedup doesn't skip the work
+                    data = chunk if offset else i.to_bytes(8, 'big') + chunk[8:]
+                    offset = append_stream(part, offset, BytesIO(data[:size - offset]).read, size)
+                store_blob(part, directory)
+
+        workers = [Thread(target=uploader, args=(n,)) for n in range(threads)]
+        started = perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = perf_counter() - started
+
+    return uploads * size / 1024 / 1024 / elapsed
+
+
+# endregion
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m app.attachments', description="Attachment storage tools.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    bench_cmd = commands.add_parser('bench', help="Measure concurrent upload throughput.")
+    bench_cmd.add_argument('--uploads', type=int, default=16)
+    bench_cmd.add_argument('--size', type=int, default=8 * 1024 * 1024)
+    bench_cmd.add_argument('--threads', type=int, default=8)
+
+    args: Any = parser.parse_args()
+    rate = benchmark(args.uploads, args.size, args.threads)
+    print(f"{args.uploads} uploads x {args.size} bytes, {args.threads} threads: {rate:.1f} MiB/s")
@@ -0,0 +1,322 @@
+from sqlite3 import connect, Connection
+from typing import Any, IO, Dict, List, Optional, Tuple
+from argparse import ArgumentParser
+from threading import Event, Thread
+from time import sleep, time as unixtime
+from json import dumps, loads
+from pathlib import Path
+import shutil
+import gzip
+import sys
+import os
+
+from app.applib import logf
+from app.config import get_settings
+
+
+__all__ = ["backup_database", "snapshot", "prune", "start_scheduler", "export_messages", "restore"]
+
+
+def backups_dir() -> Path:
+    return get_settings().data_dir/'backups'
+
+
+def backup_database(source: Connection, target: Path, pages: Optional[int] = None, pause: Optional[float] = None) -> None:
+    """Copy a live database into `target` with the SQLite online backup API.
+    The source is only locked while a step of `pages` runs, the `pause` after it lets writers in.
+    A write through any other connection between two steps restarts the copy from the first page,
+    so a stepped copy only makes progress from the connection the server itself writes through."""
+
+    pages = pages if pages is not None else get_settings().backup_step_pages
+    pause = pause if pause is not None else get_settings().backup_step_pause
+
+    def throttle(status: int, remaining: int, total: int) -> None:
+        if remaining:
+            sleep(pause)
+
+    destination = connect(target)
+    try:
+        source.backup(destination, pages=pages, progress=throttle)
+    finally:
+        destination.close()
+
+
+# region SNAPSHOTS
+def snapshot(directory: Optional[Path] = None, keep: Optional[int] = None, data_dir: Optional[Path] = None) -> Path:
+    """Back up server.sqlite and every message shard into a new snapshot directory and drop old ones.
+    Without `data_dir` the copy runs in throttled steps from this process's own connections, that is
+    how the server's scheduler takes it. With `data_dir` (the CLI) every file is opened separately and
+    copied in one step, so the server's writes can't keep restarting it. Every database is WAL,
+    the server keeps writing while that step reads."""
+
+    directory = directory or backups_dir()
+    name = f'snapshot-{int(unixtime() * 1000)}'
+    partial = directory/f'{name}.partial'
+    partial.mkdir(parents=True)
+
+    if data_dir is None:
+        import app.database as app_database
+
+        backup_database(app_database.get_database(), partial/'server.sqlite')
+        shards = app_database.get_message_shards()
+        for path, conn in zip(shards.paths, shards.connections):
+            backup_database(conn, partial/path.name)
+    else:
+        from app.sharding import data_dir_lock
+
+        # Shared like the server's, keeps migrate and restore from swapping files mid copy.
+        with data_dir_lock(data_dir):
+            for path in [data_dir/'server.sqlite', *sorted(data_dir.glob('server.messages-*.sqlite'))]:
+                source = connect(f'file:{path}?mode=ro', uri=True)
+                try:
+                    backup_database(source, partial/path.name, pages=-1, pause=0)
+                finally:
+                    source.close()
+
+    final = directory/name
+    partial.rename(final)
+    prune(directory, keep)
+    logf(f"Backup snapshot written to {final}")
+    return final
+
+
+def list_snapshots(directory: Optional[Path] = None) -> List[Path]:
+    "Finished snapshots, oldest first."
+
+    directory = directory or backups_dir()
+    if not directory.exists():
+        return []
+    return sorted(path for path in directory.glob('snapshot-*') if path.is_dir() and not path.name.endswith('.partial'))
+
+
+def prune(directory: Optional[Path] = None, keep: Optional[int] = None) -> List[Path]:
+    "Delete all but the newest `keep` snapshots and return the removed ones."
+
+    keep = keep if keep is not None else get_settings().backup_keep
+    snapshots = list_snapshots(directory)
+    removed = snapshots[:-keep] if keep > 0 else snapshots
+    for path in removed:
+        shutil.rmtree(path)
+    return removed
+
+
+def start_scheduler(interval: float, directory: Optional[Path] = None, keep: Optional[int] = None) -> Event:
+    "Take a snapshot every `interval` seconds in a daemon thread. Set the returned event to stop it."
+
+    stop = Event()
+
+    def loop() -> None:
+        while not stop.wait(interval):
+            try:
+                snapshot(directory, keep)
+            except Exception as e:
+                logf(f"Scheduled backup failed: {e}", 2)
+
+    Thread(target=loop, name='backup-scheduler', daemon=True).start()
+    return stop
+
+
+# endregion
+# region EXPORT / RESTORE
+def export_messages(out: IO[bytes], data_dir: Optional[Path] = None, compress: bool = True, batch: int = 1000) -> int:
+    """Stream every message as one JSON object per line into `out`, gzipped unless `compress` is False.
+    Shards are read through their own connections, WAL readers don't block writers."""
+
+    data_dir = data_dir or get_settings().data_dir
+    stream: IO[bytes] = gzip.GzipFile(fileobj=out, mode='wb') if compress else out
+    exported = 0
+    try:
+        for path in sorted(data_dir.glob('server.messages-*.sqlite')):
+            conn = connect(f'file:{path}?mode=ro', uri=True)
+            try:
+                cursor = conn.execute("SELECT user, chat, text, time, attachments FROM messages ORDER BY rowid")
+                while rows := cursor.fetchmany(batch):
+                    stream.write(b''.join(
+                        dumps({"chat": chat, "user": user, "text": text, "time": time, "attachments": loads(attachments)},
+                              ensure_ascii=False).encode() + b'\n'
+                        for user, chat, text, time, attachments in rows
+                    ))
+                    exported += len(rows)
+            finally:
+                conn.close()
+    finally:
+        if compress:
+            stream.close()
+    return exported
+
+
+def _restore_marker(directory: Path) -> Path:
+    return directory/'server.restoring'
+
+
+def _write_restore_marker(directory: Path, state: Dict[str, Any]) -> None:
+    tmp = directory/'server.restoring.tmp'
+    tmp.write_text(dumps(state))
+    os.replace(tmp, _restore_marker(directory))
+
+
+def _with_journal(path: Path) -> List[Path]:
+    return [path, Path(f'{path}-wal'), Path(f'{path}-shm')]
+
+
+def pending_restore(directory: Path) -> bool:
+    "True if a restore copied the snapshot but was interrupted before swapping it in."
+
+    return _restore_marker(directory).exists()
+
+
+def _finish_restore(directory: Path) -> None:
+    """Swap the staged .restore files in, the same way sharding finishes a migration:
+    every step checks what is already done, so after a crash it is simply run again.
+    The live files (with their -wal and -shm) are kept as .old until all new ones are in place."""
+
+    marker = _restore_marker(directory)
+    state = loads(marker.read_text())
+
+    def advance(phase: str) -> None:
+        state["phase"] = phase
+        _write_restore_marker(directory, state)
+
+    if state["phase"] == 'copied':
+        for name in state["old"]:
+            for path, old in zip(_with_journal(directory/name), _with_journal(directory/f'{name}.old')):
+                if path.exists() and not old.exists():
+                    path.rename(old)
+        advance('old_moved')
+
+    if state["phase"] == 'old_moved':
+        for name in state["new"]:
+            staged = directory/f'{name}.restore'
+            if staged.exists():
+                staged.rename(directory/name)
+        advance('swapped')
+
+    for name in state["old"]:
+        for path in _with_journal(directory/f'{name}.old'):
+            path.unlink(missing_ok=True)
+    marker.unlink()
+
+
+def restore(source: Path, data_dir: Optional[Path] = None) -> List[Path]:
+    """Replace the live database files with a snapshot. Refuses while the server is running.
+    The snapshot is copied next to the live files as .restore first and swapped in once complete,
+    an interrupted swap is finished by the next run. Shard files that are not part of the snapshot
+    are removed so the shard count matches it."""
+
+    from app.sharding import data_dir_lock, pending_migration
+
+    data_dir = data_dir or get_settings().data_dir
+    files = sorted(source.glob('*.sqlite'))
+    if not any(path.name == 'server.sqlite' for path in files):
+        raise Exception(f"{source} is not a snapshot, server.sqlite is missing.")
+
+    with data_dir_lock(data_dir, exclusive=True):
+        if pending_migration(data_dir):
+            raise Exception("A shard migration was interrupted, run `python -m app.sharding migrate` to finish it first.")
+        if pending_restore(data_dir):
+            logf("Finishing an interrupted restore.", 1)
+            _finish_restore(data_dir)
+
+        # Without a marker the copy never completed, the live files are untouched.
+        for path in data_dir.glob('*.sqlite.restore'):
+            path.unlink()
+
+        for path in files:
+            snapshot_db = connect(f'file:{path}?mode=ro', uri=True)
+            try:
+                backup_database(snapshot_db, data_dir/f'{path.name}.restore', pages=-1, pause=0)
+            finally:
+                snapshot_db.close()
+
+        live = [data_dir/'server.sqlite', *sorted(data_dir.glob('server.messages-*.sqlite'))]
+        _write_restore_marker(data_dir, {"phase": 'copied', "new": [path.name for path in files],
+                                         "old": [path.name for path in live if path.exists()]})
+        _finish_restore(data_dir)
+
+    restored = [data_dir/path.name for path in files]
+    logf(f"Restored {len(restored)} database files from {source}")
+    return restored
+
+
+# endregion
+# region TOOLS
+def benchmark(messages: int = 2000, pages: Optional[int] = None, pause: Optional[float] = None,
+              preload: int = 200_000) -> Tuple[Tuple[float, float, float], Tuple[float, float, float]]:
+    """Insert `messages` rows into a shard holding `preload` rows, first idle and then while the shard
+    is being backed up. Returns ((p50, p99, max) idle, (p50, p99, max) during backup) in ms.
+    The backup goes through the connection the inserts use, like the server's scheduler: a step holds
+    that connection until it ends, so with `pages=-1` one insert waits for the whole copy."""
+
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+    from app.sharding import ShardSet
+
+    def latencies(shards: ShardSet) -> Tuple[float, float, float]:
+        timings: List[float] = []
+        for i in range(messages):
+            started = perf_counter()
+            shards.insert(1, 1, "benchmark", float(i))
+            timings.append((perf_counter() - started) * 1000)
+        timings.sort()
+        return (timings[len(timings) // 2], timings[int(len(timings) * 0.99)], timings[-1])
+
+    with TemporaryDirectory() as tmp:
+        shards = ShardSet(1, Path(tmp))
+        shards.insert_many((1, 1, "x" * 200, float(i), "[]") for i in range(preload))
+        idle = latencies(shards)
+
+        worker = Thread(target=backup_database, args=(shards.connections[0], Path(tmp)/'backup.sqlite', pages, pause))
+        worker.start()
+        # the inserts barely give up the GIL, let the backup open its target and start the first step
+        sleep(0.01)
+        busy = latencies(shards)
+        worker.join()
+        shards.close()
+    return (idle, busy)
+
+
+# endregion
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m app.backup', description="Database backup tools.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    snapshot_cmd = commands.add_parser('snapshot', help="Take a snapshot of the running databases.")
+    snapshot_cmd.add_argument('--keep', type=int, default=get_settings().backup_keep)
+
+    commands.add_parser('list', help="List snapshots.")
+
+    export_cmd = commands.add_parser('export', help="Export messages as NDJSON.")
+    export_cmd.add_argument('output', nargs='?', help="Output file, stdout if omitted.")
+    export_cmd.add_argument('--no-compress', action='store_true')
+
+    restore_cmd = commands.add_parser('restore', help="Restore a snapshot. Stop the server first.")
+    restore_cmd.add_argument('snapshot', nargs='?', help="Snapshot directory, the newest one if omitted.")
+
+    bench_cmd = commands.add_parser('bench', help="Compare message write latency with and without a running backup.")
+    bench_cmd.add_argument('--messages', type=int, default=2000)
+    bench_cmd.add_argument('--preload', type=int, default=200_000)
+
+    args: Any = parser.parse_args()
+    if args.command == 'snapshot':
+        print(snapshot(keep=args.keep, data_dir=get_settings().data_dir))
+    elif args.command == 'list':
+        for path in list_snapshots():
+            print(path)
+    elif args.command == 'export':
+        out: IO[bytes] = open(args.output, 'wb') if args.output else sys.stdout.buffer
+        with out:
+            count = export_messages(out, compress=not args.no_compress)
+        print(f"Exported {count} messages.", file=sys.stderr)
+    elif args.command == 'restore':
+        snapshots = list_snapshots()
+        source: Optional[Path] = Path(args.snapshot) if args.snapshot else (snapshots[-1] if snapshots else None)
+        if source is None:
+            sys.exit("No snapshots found.")
+        for path in restore(source):
+            print(path)
+    else:
+        idle, busy = benchmark(args.messages, preload=args.preload)
+        print(f"idle:          p50 {idle[0]:.3f} ms, p99 {idle[1]:.3f} ms, max {idle[2]:.3f} ms")
+        print(f"during backup: p50 {busy[0]:.3f} ms, p99 {busy[1]:.3f} ms, max {busy[2]:.3f} ms")
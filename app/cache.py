@@ -0,0 +1,145 @@
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+from collections import OrderedDict
+from time import time as unixtime
+from dataclasses import dataclass
+from functools import wraps
+from hashlib import sha1
+from threading import Lock
+import gzip
+import zlib
+
+from flask import Response, current_app, request
+
+from app.config import get_settings
+import app.database as app_database
+
+
+__all__ = ["cached_response", "stream_json"]
+
+
+# Bodies smaller than this are sent as is, gzip would barely help.
+GZIP_MIN_SIZE: int = 1024
+# Items serialized together before a streamed chunk is handed to the server.
+STREAM_BATCH: int = 64
+
+
+@dataclass
+class CachedResponse:
+    generations: Tuple[int, ...]
+    created: float
+    etag: str
+    body: bytes
+    gzipped: Optional[bytes] = None
+
+
+_cache_lock = Lock()
+_cache: "OrderedDict[Tuple[str, ...], CachedResponse]" = OrderedDict()
+
+
+def clear() -> None:
+    with _cache_lock:
+        _cache.clear()
+
+
+def _accepts_gzip() -> bool:
+    # Parsed with q-values, so "gzip;q=0" is a refusal.
+    return request.accept_encodings['gzip'] > 0
+
+
+def _lookup(key: Tuple[str, ...], generations: Tuple[int, ...]) -> Optional[CachedResponse]:
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        if entry.generations != generations or unixtime() - entry.created > get_settings().response_cache_ttl:
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return entry
+
+
+def _store(key: Tuple[str, ...], entry: CachedResponse) -> None:
+    with _cache_lock:
+        _cache[key] = entry
+        _cache.move_to_end(key)
+        while len(_cache) > get_settings().response_cache_size:
+            _cache.popitem(last=False)
+
+
+def _respond(entry: CachedResponse) -> Response:
+    if request.if_none_match.contains_weak(entry.etag):
+        response = Response(status=304)
+    elif len(entry.body) >= GZIP_MIN_SIZE and _accepts_gzip():
+        if entry.gzipped is None:
+            entry.gzipped = gzip.compress(entry.body, compresslevel=6)
+        response = Response(entry.gzipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(entry.body, mimetype='application/json')
+
+    response.set_etag(entry.etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def cached_response(*tables: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Cache a JSON view by path and query parameters until one of `tables` is written.
+    Clients get a weak ETag and a 304 for If-None-Match, gzip when they accept it.
+    Views returning a Response (a streamed page) are passed through untouched."""
+
+    def decorator(view: Callable[..., Any]) -> Callable[..., Any]:
+        @wraps(view)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            key = (request.path, *sorted(f'{k}={v}' for k, v in request.args.items(multi=True)))
+            generations = app_database.get_generations(*tables)
+
+            entry = _lookup(key, generations)
+            if entry is None:
+                result = view(*args, **kwargs)
+                if isinstance(result, Response):
+                    return result
+
+                body = current_app.json.dumps(result).encode()
+                entry = CachedResponse(generations, unixtime(), sha1(body).hexdigest(), body)
+                _store(key, entry)
+            return _respond(entry)
+        return wrapper
+    return decorator
+
+
+def stream_json(prefix: str, items: Iterable[Any], suffix: str) -> Response:
+    """Send `prefix`, the items as a JSON array body and `suffix` chunk by chunk,
+    so the page is never built in memory. Gzipped on the fly when the client accepts it."""
+
+    dumps: Callable[[Any], str] = current_app.json.dumps
+
+    def chunks() -> Iterator[bytes]:
+        yield prefix.encode()
+        batch = []
+        first = True
+        for item in items:
+            batch.append(dumps(item))
+            if len(batch) >= STREAM_BATCH:
+                yield (('' if first else ',') + ','.join(batch)).encode()
+                batch.clear()
+                first = False
+        if batch:
+            yield (('' if first else ',') + ','.join(batch)).encode()
+        yield suffix.encode()
+
+    def gzipped(source: Iterator[bytes]) -> Iterator[bytes]:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in source:
+            if data := compressor.compress(chunk):
+                yield data
+        yield compressor.flush()
+
+    encode = _accepts_gzip()
+    response = Response(gzipped(chunks()) if encode else chunks(), mimetype='application/json')
+    if encode:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
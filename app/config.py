@@ -0,0 +1,94 @@
+from typing import Optional
+from pathlib import Path
+import secrets
+import os
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from app.applib import JsonD
+
+
+__all__ = ["Settings", "get_settings", "configure", "secret_key"]
+
+
+class Settings(BaseSettings):
+    """Server configuration. Every field can be set with a RENALE_<NAME> environment variable or in .env."""
+
+    model_config = SettingsConfigDict(env_prefix='RENALE_', env_file='.env', extra='ignore')
+
+    data_dir: Path = Path(__file__).parent.parent
+    # Empty means a key generated once and stored in data_dir, so every worker signs sessions the same way.
+    secret_key: str = ""
+
+    host: str = '127.0.0.1'
+    port: int = 9789
+    debug: bool = True
+
+    # Signing in on one more device drops the session seen least recently.
+    max_sessions: int = 20
+
+    message_shards: int = 4
+    cached_statements: int = 128
+    # Run app.database.prewarm() from create_app.
+    prewarm: bool = False
+
+    max_upload_size: int = 100 * 1024 * 1024
+    # Unfinished uploads older than this many seconds are deleted with their partial files
+    # when a new upload starts (at most once a minute).
+    upload_ttl: float = 24 * 60 * 60
+
+    response_cache_size: int = 256
+    # Cached API responses are rebuilt after this many seconds even without a local write,
+    # which bounds staleness when another process writes to the same database.
+    response_cache_ttl: float = 5.0
+    # /api/* pages with a bigger `count` are streamed instead of cached.
+    stream_threshold: int = 500
+
+    backup_step_pages: int = 64
+    backup_step_pause: float = 0.005
+    backup_keep: int = 7
+    # Seconds between scheduled snapshots, 0 turns the scheduler off.
+    backup_interval: float = 0
+
+
+_settings: Optional[Settings] = None
+
+
+def get_settings() -> Settings:
+    global _settings
+
+    if _settings is None:
+        _settings = Settings()
+    return _settings
+
+
+def configure(config: Optional[Settings | JsonD] = None) -> Settings:
+    "Replace the active settings. A dict is applied on top of the environment."
+
+    global _settings
+
+    if config is None:
+        _settings = Settings()
+    elif isinstance(config, Settings):
+        _settings = config
+    else:
+        _settings = Settings(**config)
+    return _settings
+
+
+def secret_key(settings: Settings) -> str:
+    if settings.secret_key:
+        return settings.secret_key
+
+    path = settings.data_dir/'.secret_key'
+    if not path.exists():
+        # Written aside and linked into place so workers starting together never read a half written key.
+        candidate = settings.data_dir/f'.secret_key.{os.getpid()}'
+        candidate.write_text(secrets.token_hex(32))
+        try:
+            os.link(candidate, path)
+        except FileExistsError:
+            pass
+        finally:
+            candidate.unlink()
+    return path.read_text().strip()
@@ -1,19 +1,38 @@
-from sqlite3 import connect, OperationalError, Row, Cursor, Connection
-from typing import Any, Dict, List, Optional, Tuple, Callable
+from sqlite3 import connect, Row, Cursor, Connection
+from typing import Any, IO, Dict, Iterator, List, Optional, Tuple, Callable
 from json import dumps, loads
 from time import time as unixtime
-from pathlib import Path
+from threading import Event, Lock, Thread
+from uuid import uuid4
+import atexit
 
-from app.applib import Json, JsonD, random_id, logf
+from app.applib import Json, JsonD, random_id, random_token, logf
+from app.sharding import ShardSet, data_dir_lock, pending_migration
+from app.backup import pending_restore
+from app.config import Settings, get_settings
 
 
-__all__: List[str] = ["app_database", "Session"]
+__all__: List[str] = ["init_database", "close_database", "get_database", "get_message_shards", "prewarm", "Session"]
+
+
+# last_seen updates are buffered here and written in one executemany
+# instead of touching user_sessions on every authenticated request.
+LAST_SEEN_FLUSH_SIZE: int = 64
+LAST_SEEN_FLUSH_INTERVAL: float = 30.0
+
+_last_seen_lock = Lock()
+_last_seen_pending: Dict[str, float] = {}
+_last_seen_flushed: float = unixtime()
+
+# Bumped on every write to a table so cached API responses know they are stale.
+_generations_lock = Lock()
+_generations: Dict[str, int] = {"users": 0, "chats": 0, "messages": 0}
 
 
 def db_link(default: Any = None) -> Callable[..., Any]:
     def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
         def wrapper(*args: List[Any], **kwargs: Dict[str, Any]) -> Any:
-            sql: Cursor = app_database.cursor()
+            sql: Cursor = get_database().cursor()
             try:
                 return func(sql, *args, **kwargs)
             except Exception as e:
@@ -25,6 +44,48 @@ def db_link(default: Any = None) -> Callable[..., Any]:
     return decorator
 
 
+def shard_link(default: Any = None) -> Callable[..., Any]:
+    "db_link for functions that only read the message shards, no cursor on server.sqlite is opened."
+
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        def wrapper(*args: List[Any], **kwargs: Dict[str, Any]) -> Any:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                logf(f"Error in {func.__name__}({', '.join((f'{i!r}' for i in args))}): {str(e)}", 2)
+                return default
+        return wrapper
+    return decorator
+
+
+def db_stream(func: Callable[..., Iterator[Any]]) -> Callable[..., Iterator[Any]]:
+    """db_link for generators: the cursor stays open until the caller stops iterating.
+    Errors are logged and raised again, a response already being streamed can't fall back to a default
+    and has to be cut off instead of ending like a complete page."""
+
+    def wrapper(*args: List[Any], **kwargs: Dict[str, Any]) -> Iterator[Any]:
+        sql: Cursor = get_database().cursor()
+        try:
+            yield from func(sql, *args, **kwargs)
+        except Exception as e:
+            logf(f"Error in {func.__name__}({', '.join((f'{i!r}' for i in args))}): {str(e)}", 2)
+            raise
+        finally:
+            sql.close()
+    return wrapper
+
+
+def bump_generation(*tables: str) -> None:
+    with _generations_lock:
+        for table in tables:
+            _generations[table] += 1
+
+
+def get_generations(*tables: str) -> Tuple[int, ...]:
+    with _generations_lock:
+        return tuple(_generations[table] for table in tables)
+
+
 class Session:
     def __init__(self, version, system, architecture, release):  # type: ignore
         self.version = version
@@ -47,37 +108,198 @@ Session info:
 """.strip()
 
 
+# region SESSIONS
+def _session_json(row: Row) -> JsonD:
+    return {"session_id": row["session_id"],
+            "created": row["created"],
+            "last_seen": row["last_seen"],
+            "client_info": loads(row["client_info"])}
+
+
+def _load_sessions(sql: Cursor, user_id: int) -> List[JsonD]:
+    sql.execute("SELECT session_id, created, last_seen, client_info FROM user_sessions WHERE user_id =? ORDER BY created",
+                (user_id,))
+    return [_session_json(row) for row in sql.fetchall()]
+
+
+def _new_session(sql: Cursor, user_id: int, client_info: Json) -> Tuple[str, str]:
+    """Insert a session row for the user and return its id and token. Caller commits.
+    Past `max_sessions` the sessions seen least recently are dropped."""
+
+    session_id = uuid4().hex
+    token = random_token()
+    now = unixtime()
+    sql.execute(
+        "INSERT INTO user_sessions (user_id, session_id, token, created, last_seen, client_info) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, session_id, token, now, now, dumps(client_info)),
+    )
+    sql.execute("""DELETE FROM user_sessions WHERE user_id =? AND session_id NOT IN
+                   (SELECT session_id FROM user_sessions WHERE user_id =? ORDER BY last_seen DESC LIMIT ?)""",
+                (user_id, user_id, get_settings().max_sessions))
+    return (session_id, token)
+
+
+def _migrate_legacy_sessions(database: Connection) -> int:
+    """Move client info kept in the users.sessions JSON of old databases into user_sessions.
+    Those sessions never had tokens of their own, they get a fresh one nobody knows and
+    the account token keeps working. Returns the number of moved sessions."""
+
+    if 'sessions' not in [column["name"] for column in database.execute("PRAGMA table_info(users)")]:
+        return 0
+
+    moved = 0
+    with database:
+        for row in database.execute("SELECT id, sessions FROM users WHERE sessions != '[]'").fetchall():
+            try:
+                sessions = loads(row["sessions"])
+            except ValueError:
+                logf(f"Dropping unreadable sessions of user {row['id']}: {row['sessions']!r}", 1)
+                sessions = []
+            if not isinstance(sessions, list):
+                sessions = [sessions]
+
+            now = unixtime()
+            database.executemany(
+                "INSERT INTO user_sessions (user_id, session_id, token, created, last_seen, client_info) VALUES (?, ?, ?, ?, ?, ?)",
+                [(row["id"], uuid4().hex, random_token(), now, now, dumps(info)) for info in sessions],
+            )
+            database.execute("UPDATE users SET sessions = '[]' WHERE id =?", (row["id"],))
+            moved += len(sessions)
+    return moved
+
+
+def _verify_token(sql: Cursor, user_id: int, token: str) -> bool:
+    """Returns True if `token` is either the user's account token or the token of one of their sessions.
+    A matching session gets its last_seen queued for the next batched write."""
+
+    sql.execute("SELECT session_id FROM user_sessions WHERE token =? AND user_id =?", (token, user_id))
+    row = sql.fetchone()
+    if row is not None:
+        touch_session(row["session_id"])
+        return True
+
+    sql.execute("SELECT token FROM users WHERE id =?", (user_id,))
+    row = sql.fetchone()
+    return row is not None and row["token"] == token
+
+
+def touch_session(session_id: str) -> None:
+    "Queue a last_seen update; it is written once enough updates piled up or the flush interval passed."
+
+    global _last_seen_flushed
+
+    now = unixtime()
+    with _last_seen_lock:
+        _last_seen_pending[session_id] = now
+        if len(_last_seen_pending) < LAST_SEEN_FLUSH_SIZE and now - _last_seen_flushed < LAST_SEEN_FLUSH_INTERVAL:
+            return
+    flush_last_seen()
+
+
+@db_link(0)
+def flush_last_seen(sql: Cursor) -> int:
+    "Write all queued last_seen updates and return how many sessions were updated."
+
+    global _last_seen_flushed
+
+    with _last_seen_lock:
+        pending = list(_last_seen_pending.items())
+        _last_seen_pending.clear()
+        _last_seen_flushed = unixtime()
+
+    if not pending:
+        return 0
+
+    sql.executemany("UPDATE user_sessions SET last_seen =? WHERE session_id =?",
+                    [(seen, session_id) for session_id, seen in pending])
+    get_database().commit()
+    return len(pending)
+
+
+def _start_last_seen_flusher() -> Event:
+    "Flush queued last_seen updates every LAST_SEEN_FLUSH_INTERVAL seconds until the returned event is set."
+
+    stop = Event()
+
+    def loop() -> None:
+        while not stop.wait(LAST_SEEN_FLUSH_INTERVAL):
+            # close_database() can't run in between, a flush after it would quietly connect again.
+            with _connect_lock:
+                if stop.is_set() or _database is None:
+                    return
+                if _last_seen_pending:
+                    flush_last_seen()
+
+    Thread(target=loop, name='last-seen-flusher', daemon=True).start()
+    return stop
+
+
+@db_link(False)
+def check_token(sql: Cursor, user_id: int, token: str) -> bool:
+    return _verify_token(sql, user_id, token)
+
+
+@db_link([])
+def get_sessions(sql: Cursor, user_id: int) -> List[JsonD]:
+    return _load_sessions(sql, user_id)
+
+
+@db_link(False)
+def revoke_session(sql: Cursor, user_id: int, token: str, session_id: str) -> bool:
+    "Delete one of the user's sessions. Returns True if a session was removed."
+
+    if not _verify_token(sql, user_id, token):
+        return False
+
+    sql.execute("DELETE FROM user_sessions WHERE user_id =? AND session_id =?", (user_id, session_id))
+    get_database().commit()
+    with _last_seen_lock:
+        _last_seen_pending.pop(session_id, None)
+    return sql.rowcount > 0
+
+
+# endregion
 # region GET USER
 @db_link({})
-def get_users(sql: Cursor, start: int = 0, count: int = 50) -> List[JsonD]:
-    sql.execute("SELECT id, name, sessions FROM users ORDER BY id DESC LIMIT ? OFFSET ?", (count, start))
+def get_users(sql: Cursor, start: int = 0, count: int = 50, with_sessions: bool = False) -> List[JsonD]:
+    sql.execute("SELECT id, name FROM users ORDER BY id DESC LIMIT ? OFFSET ?", (count, start))
     rows = sql.fetchall()
 
-    return [{"id": row["id"],
-             "name": row["name"],
-             "sessions": loads(row["sessions"])}
-            for row in rows
-            ]
+    users: List[JsonD] = [{"id": row["id"], "name": row["name"]} for row in rows]
+    if with_sessions:
+        for user in users:
+            user["sessions"] = _load_sessions(sql, user["id"])
+    return users
+
+
+@db_stream
+def iter_users(sql: Cursor, start: int = 0, count: int = 50) -> Iterator[JsonD]:
+    "get_users for big pages, rows are read from the cursor one at a time."
+
+    for row in sql.execute("SELECT id, name FROM users ORDER BY id DESC LIMIT ? OFFSET ?", (count, start)):
+        yield {"id": row["id"], "name": row["name"]}
 
 
 @db_link({})
-def get_user_by_id(sql: Cursor, id: int) -> JsonD:
-    sql.execute("SELECT id, name, sessions FROM users WHERE id =?", (id,))
+def get_user_by_id(sql: Cursor, id: int, with_sessions: bool = False) -> JsonD:
+    sql.execute("SELECT id, name FROM users WHERE id =?", (id,))
     row = sql.fetchone()
 
-    return {"id": row["id"],
-            "name": row["name"],
-            "sessions": row["sessions"]}
+    user: JsonD = {"id": row["id"], "name": row["name"]}
+    if with_sessions:
+        user["sessions"] = _load_sessions(sql, row["id"])
+    return user
 
 
 @db_link({})
-def get_user_by_name(sql: Cursor, name: str) -> JsonD:
-    sql.execute("SELECT id, name, sessions FROM users WHERE name =?", (name,))
+def get_user_by_name(sql: Cursor, name: str, with_sessions: bool = False) -> JsonD:
+    sql.execute("SELECT id, name FROM users WHERE name =?", (name,))
     row = sql.fetchone()
 
-    return {"id": row["id"],
-            "name": row["name"],
-            "sessions": loads(row["sessions"])}
+    user: JsonD = {"id": row["id"], "name": row["name"]}
+    if with_sessions:
+        user["sessions"] = _load_sessions(sql, row["id"])
+    return user
 
 
 @db_link(-1)
@@ -113,87 +335,196 @@ def count_users(sql: Cursor) -> int:
 # region POST USER
 @db_link((-1, "Error creating user"))
 def create_user(sql: Cursor, id: int, name: str, password: str, token: str, session: Json) -> Tuple[int, str]:
-    "Register user in database and return user's id and token."
+    "Register user in database and return user's id and the token of the first session."
 
+    # users.sessions is kept only for old schemas, sessions live in user_sessions.
     sql.execute(
         "INSERT INTO users (id, name, password, token, sessions, chats) VALUES (?, ?, ?, ?, ?, ?)",
-        (id, name, password, token, dumps([session]), "[]"),
+        (id, name, password, token, "[]", "[]"),
     )
-    app_database.commit()
-    return (id, token)
+    _, session_token = _new_session(sql, id, session)
+    get_database().commit()
+    bump_generation("users")
+    return (id, session_token)
 
 
 @db_link((-1, "User not found"))
-def login_user(sql: Cursor, name: str, password: str) -> Tuple[int, str]:
-    """Authenticate user by name and password and return user's id and token. If credentials are invalid, return id -1(invalid) and an error message."""
+def login_user(sql: Cursor, name: str, password: str, session: Optional[Json] = None) -> Tuple[int, str]:
+    """Authenticate user by name and password, open a new session and return user's id and the session token. If credentials are invalid, return id -1(invalid) and an error message."""
 
-    sql.execute("SELECT id, name, password, token, sessions FROM users WHERE name =?", (name,))
+    sql.execute("SELECT id, name, password FROM users WHERE name =?", (name,))
     user = sql.fetchone()
 
     if user and user["password"] == password:
-        return (user["id"], user["token"])
+        _, session_token = _new_session(sql, user["id"], session or {})
+        get_database().commit()
+        return (user["id"], session_token)
     else:
         return (-1, "Invalid credentials")
 
 
 @db_link()
-def update_sessions(sql: Cursor, id: int, token: str, new_session: Json) -> None:
-    sql.execute("SELECT token FROM users WHERE id =?", (id,))
-    user_token = sql.fetchone()["token"]
-    if user_token == token:
-        sql.execute(
-            "SELECT id, name, sessions FROM users WHERE id =?", (id,)
-        )
-        sessions: List[Json] = sql.fetchall()
-        sessions.append(new_session)
-        sql.execute("UPDATE users SET sessions =? WHERE id =?", (sessions, id))
+def update_sessions(sql: Cursor, id: int, token: str, new_session: Json) -> Optional[Tuple[str, str]]:
+    "Open one more session for an already authenticated user and return its id and token."
+
+    if not _verify_token(sql, id, token):
+        return None
+
+    created = _new_session(sql, id, new_session)
+    get_database().commit()
+    return created
 
 
 @db_link()
 def change_password(sql: Cursor, id: int, new_password: str) -> None:
     sql.execute("UPDATE users SET password =? WHERE id =?", (new_password, id))
-    app_database.commit()
+    get_database().commit()
 
 
 # endregion
 # region GET MESSAGE
-@db_link([])
-def get_messages(sql: Cursor, start: int = 0, count: int = 50) -> List[Dict[str, Any]]:
-    sql.execute("SELECT * FROM messages ORDER BY time DESC LIMIT ? OFFSET ?", (count, start))
-    rows = sql.fetchall()
+# Messages don't live in server.sqlite, they are spread over the message shards by chat_id.
+@shard_link([])
+def get_messages(start: int = 0, count: int = 50) -> List[Dict[str, Any]]:
+    return get_message_shards().recent(start, count)
 
-    return [{"chat": row["chat"],
-             "user": row["user"],
-             "text": row["text"],
-             "time": row["time"],
-             } for row in rows]
 
+def iter_messages(start: int = 0, count: int = 50) -> Iterator[JsonD]:
+    return get_message_shards().iter_recent(start, count)
 
-@db_link(-1)
-def count_messages(sql: Cursor) -> int:
-    sql.execute("SELECT COUNT(*) FROM messages")
-    count = int(sql.fetchone()['COUNT(*)'])
 
-    return count
+@shard_link(-1)
+def count_messages() -> int:
+    return get_message_shards().count_messages()
 
 
 # endregion
 # region POST MESSAGE
 @db_link(False)
-def send_message(sql: Cursor, user_id: int, user_token: str, chat_id: int, text: str) -> str | JsonD:
-    """Send a message to a chat."""
-
-    sql.execute("SELECT token FROM users WHERE id =?", (user_id,))
-    user_token_ = sql.fetchone()["token"]
-    if user_token == user_token_:
-        sql.execute("INSERT INTO messages (user, chat, text, time) VALUES (?, ?, ?, ?)",
-                    (user_id, chat_id, text, unixtime()))
-        app_database.commit()
-        return {"user_id": user_id, "chat_id": chat_id, "text": text, "time": unixtime()}
+def send_message(sql: Cursor, user_id: int, user_token: str, chat_id: int, text: str, attachments: Optional[List[str]] = None) -> str | JsonD:
+    """Send a message to a chat. `attachments` are ids returned by a finished upload."""
+
+    if _verify_token(sql, user_id, user_token):
+        if not _is_member(sql, user_id, chat_id):
+            return "Chat not found"
+
+        attachments = attachments or []
+        if attachments:
+            # Only the sender's own uploads or attachments that were already posted in this chat.
+            placeholders = ', '.join('?' * len(attachments))
+            sql.execute(f"""SELECT COUNT(*) FROM attachments WHERE attachment_id IN ({placeholders})
+                            AND (user_id =? OR attachment_id IN (SELECT attachment_id FROM attachment_chats WHERE chat_id =?))""",
+                        (*attachments, user_id, chat_id))
+            if sql.fetchone()['COUNT(*)'] != len(set(attachments)):
+                return "Attachment not found"
+            sql.executemany("INSERT OR IGNORE INTO attachment_chats (attachment_id, chat_id) VALUES (?, ?)",
+                            [(attachment_id, chat_id) for attachment_id in set(attachments)])
+            get_database().commit()
+
+        time = unixtime()
+        get_message_shards().insert(user_id, chat_id, text, time, attachments)
+        bump_generation("messages")
+        return {"user_id": user_id, "chat_id": chat_id, "text": text, "time": time, "attachments": attachments}
     else:
         return "Invalid token"
 
 
+# endregion
+# region ATTACHMENTS
+@db_link("Error creating upload")
+def create_upload(sql: Cursor, user_id: int, user_token: str, name: str, mime: str, size: int) -> str | JsonD:
+    "Start a chunked upload and return its state."
+
+    if not _verify_token(sql, user_id, user_token):
+        return "Invalid token"
+
+    upload_id = uuid4().hex
+    sql.execute("INSERT INTO uploads (upload_id, user_id, name, mime, size, received, created) VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (upload_id, user_id, name, mime, size, unixtime()))
+    get_database().commit()
+    return {"upload_id": upload_id, "size": size, "received": 0}
+
+
+@db_link({})
+def get_upload(sql: Cursor, upload_id: str) -> JsonD:
+    sql.execute("SELECT upload_id, user_id, name, mime, size, received FROM uploads WHERE upload_id =?", (upload_id,))
+    row = sql.fetchone()
+
+    return {"upload_id": row["upload_id"],
+            "user_id": row["user_id"],
+            "name": row["name"],
+            "mime": row["mime"],
+            "size": row["size"],
+            "received": row["received"]}
+
+
+@db_link()
+def set_upload_received(sql: Cursor, upload_id: str, received: int) -> None:
+    sql.execute("UPDATE uploads SET received =? WHERE upload_id =?", (received, upload_id))
+    get_database().commit()
+
+
+@db_link({})
+def finish_upload(sql: Cursor, upload_id: str, sha256: str) -> JsonD:
+    "Turn a completed upload into an attachment pointing at the stored blob."
+
+    sql.execute("SELECT user_id, name, mime, size FROM uploads WHERE upload_id =?", (upload_id,))
+    upload = sql.fetchone()
+
+    attachment_id = uuid4().hex
+    sql.execute("INSERT INTO attachments (attachment_id, sha256, user_id, name, mime, size, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (attachment_id, sha256, upload["user_id"], upload["name"], upload["mime"], upload["size"], unixtime()))
+    sql.execute("DELETE FROM uploads WHERE upload_id =?", (upload_id,))
+    get_database().commit()
+    return {"attachment_id": attachment_id, "sha256": sha256, "name": upload["name"],
+            "mime": upload["mime"], "size": upload["size"]}
+
+
+@db_link({})
+def get_attachment(sql: Cursor, attachment_id: str) -> JsonD:
+    sql.execute("SELECT attachment_id, user_id, sha256, name, mime, size FROM attachments WHERE attachment_id =?", (attachment_id,))
+    row = sql.fetchone()
+
+    return {"attachment_id": row["attachment_id"],
+            "user_id": row["user_id"],
+            "sha256": row["sha256"],
+            "name": row["name"],
+            "mime": row["mime"],
+            "size": row["size"]}
+
+
+@db_link(False)
+def can_read_attachment(sql: Cursor, user_id: int, attachment_id: str) -> bool:
+    "Returns True if the user uploaded the attachment or is a member of a chat it was posted in."
+
+    sql.execute("SELECT user_id FROM attachments WHERE attachment_id =?", (attachment_id,))
+    row = sql.fetchone()
+    if row is None:
+        return False
+    if row["user_id"] == user_id:
+        return True
+
+    sql.execute("SELECT chat_id FROM attachment_chats WHERE attachment_id =?", (attachment_id,))
+    return any(_is_member(sql, user_id, chat_id) for (chat_id,) in sql.fetchall())
+
+
+@db_link([])
+def get_expired_uploads(sql: Cursor, before: float) -> List[str]:
+    "Ids of unfinished uploads started before `before`."
+
+    sql.execute("SELECT upload_id FROM uploads WHERE created <?", (before,))
+    return [row["upload_id"] for row in sql.fetchall()]
+
+
+@db_link(False)
+def delete_upload(sql: Cursor, upload_id: str) -> bool:
+    "Forget an unfinished upload. Returns False if it is gone already, finished or deleted."
+
+    sql.execute("DELETE FROM uploads WHERE upload_id =?", (upload_id,))
+    get_database().commit()
+    return sql.rowcount > 0
+
+
 # endregion
 # region GET CHATS
 @db_link([])
@@ -201,13 +532,32 @@ def get_chats(sql: Cursor, start: int = 50, count: int = 50) -> JsonD:
     sql.execute("SELECT is_group, chat_id, title, members FROM chats ORDER BY chat_id DESC LIMIT ? OFFSET ?", (count, start))
     rows = sql.fetchall()
 
-    return {"chats": [{"is_group": not not row["is_group"],
-                       "chat_id": row["chat_id"],
-                       "chat_name": row["title"],
-                       "members": [{"id": i["id"], "name": i["name"], "sessions": loads(i["sessions"])}
-                      for i in loads(row["members"])]}
-            for row in rows]
-            }
+    return {"chats": [_chat_json(row) for row in rows]}
+
+
+@db_stream
+def iter_chats(sql: Cursor, start: int = 50, count: int = 50) -> Iterator[JsonD]:
+    "Items of get_chats()['chats'] for big pages, rows are read from the cursor one at a time."
+
+    for row in sql.execute("SELECT is_group, chat_id, title, members FROM chats ORDER BY chat_id DESC LIMIT ? OFFSET ?", (count, start)):
+        yield _chat_json(row)
+
+
+def _chat_json(row: Row) -> JsonD:
+    return {"is_group": not not row["is_group"],
+            "chat_id": row["chat_id"],
+            "chat_name": row["title"],
+            "members": [{"id": i["id"], "name": i["name"]}
+                        for i in loads(row["members"])]}
+
+
+def _is_member(sql: Cursor, user_id: int, chat_id: int) -> bool:
+    "Returns True if the user is listed in the chat's members or admins. False for a missing chat."
+
+    sql.execute("SELECT members, admins FROM chats WHERE chat_id =?", (chat_id,))
+    row = sql.fetchone()
+    # get_user_by_id stores {} for ids that don't exist
+    return row is not None and any(i.get("id") == user_id for i in loads(row["members"]) + loads(row["admins"]))
 
 
 @db_link(False)
@@ -250,11 +600,11 @@ def count_chats(sql: Cursor) -> int:
 # endregion
 # region POST CHATS
 @db_link()
-def create_chat(sql: Cursor, creator_id: int, creator_token: str, is_group: bool, title: str, description: str, member_ids: List[int]) -> None:
-    sql.execute("SELECT token FROM users WHERE id =?", (creator_id,))
-    user_token = sql.fetchone()["token"]
-    if user_token != creator_token:
-        return
+def create_chat(sql: Cursor, creator_id: int, creator_token: str, is_group: bool, title: str, description: str, member_ids: List[int]) -> Optional[int]:
+    "Create a chat and return its id. Group ids are negative, private chat ids positive."
+
+    if not _verify_token(sql, creator_id, creator_token):
+        return None
 
     creator = get_user_by_id(creator_id)
     admins: List[JsonD] = []
@@ -273,17 +623,23 @@ def create_chat(sql: Cursor, creator_id: int, creator_token: str, is_group: bool
     else:
         title = ""
         description = ""
+        # Private chats used to share chat_id -1 and list nobody, every private chat was the same one.
+        members = [creator] + [get_user_by_id(i) for i in member_ids if i != creator_id]
+        while True:
+            chat_id = random_id()
+            if not chat_exist(chat_id):
+                break
 
     sql.execute("INSERT INTO chats (is_group, chat_id, title, description, members, admins) VALUES (?,?,?,?,?,?)",
                 (is_group, chat_id, title, description, dumps(members), dumps(admins)))
-    app_database.commit()
+    get_database().commit()
+    bump_generation("chats")
+    return chat_id
 
 
 @db_link()
 def add_members(sql: Cursor, user_id: int, user_token: str, member_ids: List[int], chat_id: int) -> None:
-    sql.execute("SELECT token FROM users WHERE id =?", (user_id,))
-    user_token_ = sql.fetchone()["token"]
-    if user_token != user_token_:
+    if not _verify_token(sql, user_id, user_token):
         return
 
     members: List[JsonD] = []
@@ -293,30 +649,172 @@ def add_members(sql: Cursor, user_id: int, user_token: str, member_ids: List[int
     sql.execute("SELECT members FROM chats WHERE chat_id = ?", (chat_id,))
     updated_members = loads(sql.fetchone()["members"]) + members
     sql.execute("UPDATE chats SET members = ? WHERE chat_id = ?", (dumps(updated_members), chat_id))
-    app_database.commit()
+    get_database().commit()
+    bump_generation("chats")
 
 
 # endregion
 # region DELETE
 @db_link(False)
 def delete_user(sql: Cursor, user_id: int, token: str) -> bool:
-    sql.execute("SELECT token FROM users WHERE id =?", (user_id,))
-    user_token = sql.fetchone()["token"]
-
-    if user_token == token:
+    if _verify_token(sql, user_id, token):
+        sql.execute("DELETE FROM user_sessions WHERE user_id =?", (user_id,))
         sql.execute("DELETE FROM users WHERE id =?", (user_id,))
-        app_database.commit()
+        get_database().commit()
+        bump_generation("users")
         return True
     else:
         return False
 # endregion
 
 
-try:
-    print(Path(__file__).parent.parent/'server.sqlite')
-    app_database: Connection = connect(Path(__file__).parent.parent/'server.sqlite', check_same_thread=False)
-    app_database.row_factory = Row
-    print('Connected successfully to the SQLite database.')
-except Exception as e:
-    logf(e, 2)
-    raise Exception(f"Error connecting to database:\n{e}")
+# region CONNECTION
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_sessions (
+    user_id INTEGER NOT NULL,
+    session_id TEXT NOT NULL PRIMARY KEY,
+    token TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    client_info TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS user_sessions_user_id ON user_sessions (user_id);
+CREATE UNIQUE INDEX IF NOT EXISTS user_sessions_token ON user_sessions (token);
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT NOT NULL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    mime TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    received INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    attachment_id TEXT NOT NULL PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    mime TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+CREATE INDEX IF NOT EXISTS uploads_created ON uploads (created);
+CREATE TABLE IF NOT EXISTS attachment_chats (
+    attachment_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    PRIMARY KEY (attachment_id, chat_id)
+);
+"""
+
+_database: Optional[Connection] = None
+_message_shards: Optional[ShardSet] = None
+_connected_settings: Optional[Settings] = None
+_flusher_stop: Optional[Event] = None
+_server_lock: Optional[IO[str]] = None
+_connect_lock = Lock()
+
+
+def init_database() -> Connection:
+    """Connect to server.sqlite and the message shards.
+    Runs on the first query, so importing this module stays cheap. Calling it again does nothing."""
+
+    global _database, _message_shards, _connected_settings, _flusher_stop, _server_lock
+
+    with _connect_lock:
+        if _database is not None:
+            return _database
+
+        settings = get_settings()
+        path = settings.data_dir/'server.sqlite'
+        try:
+            lock = data_dir_lock(settings.data_dir)
+        except Exception as e:
+            logf(e, 2)
+            raise Exception(f"Error connecting to database:\n{e}")
+
+        try:
+            if pending_migration(settings.data_dir):
+                raise Exception("A shard migration was interrupted, run `python -m app.sharding migrate` to finish it.")
+            if pending_restore(settings.data_dir):
+                raise Exception("A restore was interrupted, run `python -m app.backup restore` with the same snapshot to finish it.")
+
+            database = connect(path, check_same_thread=False, cached_statements=settings.cached_statements)
+            database.row_factory = Row
+            # WAL like the shards, so a snapshot reading the file doesn't hold off writers.
+            database.execute("PRAGMA journal_mode=WAL")
+            database.executescript(SCHEMA)
+            if moved := _migrate_legacy_sessions(database):
+                logf(f"Moved {moved} sessions from users.sessions into user_sessions.")
+            if database.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'").fetchone() \
+                    and database.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+                database.close()
+                raise Exception("server.sqlite still holds messages, run `python -m app.sharding migrate` to move them into shards.")
+            _message_shards = ShardSet()
+        except Exception as e:
+            lock.close()
+            logf(e, 2)
+            raise Exception(f"Error connecting to database:\n{e}")
+
+        _database = database
+        _server_lock = lock
+        _connected_settings = settings
+        _flusher_stop = _start_last_seen_flusher()
+        logf(f"Connected to {path}")
+        return database
+
+
+def close_database() -> None:
+    "Write pending last_seen updates and close every connection. The next query connects again."
+
+    global _database, _message_shards, _connected_settings, _flusher_stop, _server_lock
+
+    with _connect_lock:
+        if _database is None:
+            return
+        if _flusher_stop is not None:
+            _flusher_stop.set()
+        if _last_seen_pending:
+            flush_last_seen()
+        _database.close()
+        if _message_shards is not None:
+            _message_shards.close()
+        if _server_lock is not None:
+            _server_lock.close()
+        _database, _message_shards, _connected_settings, _flusher_stop, _server_lock = None, None, None, None, None
+
+
+def connected_settings() -> Optional[Settings]:
+    "Settings the open connections were made with, None when not connected."
+
+    return _connected_settings
+
+
+atexit.register(close_database)
+
+
+def get_database() -> Connection:
+    return _database if _database is not None else init_database()
+
+
+def get_message_shards() -> ShardSet:
+    if _message_shards is None:
+        init_database()
+    return _message_shards  # type: ignore
+
+
+def prewarm() -> None:
+    """Connect now and run every hot query once, so the first clients don't pay for
+    opening files, compiling statements or reading index pages from disk."""
+
+    check_token(-1, "")
+    id_exist(-1)
+    name_exist("")
+    chat_exist(0)
+    chat_title_exist("")
+    count_users()
+    count_chats()
+    get_message_shards().prewarm()
+
+
+# endregion
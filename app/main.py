@@ -3,13 +3,17 @@ __version__ = "0.0.1.dev1"
 from app.user import User
 
 from flask_socketio import SocketIO, send, emit, join_room, leave_room  # type: ignore
-from flask import Flask, request, render_template
+from flask import Blueprint, Flask, request, render_template, send_file
 from json import loads, dumps, JSONDecodeError
+from app.config import Settings, configure, get_settings, secret_key
+from app.cache import cached_response, stream_json, clear as clear_cache
 from app.applib import JsonD
-from uuid import uuid4
+from typing import Optional, Tuple
+from io import BytesIO
 
 
 import app.database as app_database
+import app.attachments as app_attachments
 
 
 # connect
@@ -19,11 +23,13 @@ import app.database as app_database
 # MessageSend
 # roomJoin
 # roomLeave
+# sessions_get
+# session_revoke
+# upload_chunk
 
 
-app: Flask = Flask(__name__)
-app.config['SECRET_KEY'] = uuid4().hex
-socketio = SocketIO(app, logger=True, engineio_logger=True)
+socketio = SocketIO(logger=True, engineio_logger=True)
+web = Blueprint('web', __name__)
 
 
 @socketio.on('connect')
@@ -48,23 +54,28 @@ def register_user(json: JsonD):
 
         if app_database.name_exist(name):
             emit('error', 'This name is already taken.')
+            return
 
-        success = User().sign_up(name, password)
-
-        if not success:
+        user: User = User()
+        if not user.sign_up(name, password):
             emit('error', 'Error.')
+            return
 
-        emit('registered', success)
+        emit('registered', {
+            'user_id': user._id,
+            'user_token': user.token,
+        })
     except JSONDecodeError:
         emit('error', 'Invalid JSON')
 
 
 @socketio.on('auth')
 def login_user(json: JsonD):
-    """Log user in.
+    """Log user in. `client_info` is optional, it is shown in the device list of sessions_get.
     {
         "name": "John Doe",
-        "password": "qwerty123"
+        "password": "qwerty123",
+        "client_info": {"device": "Pixel 8", "app": "1.2.0"}
     }
     """
 
@@ -73,7 +84,7 @@ def login_user(json: JsonD):
         password: str = json["password"]
 
         user: User = User()
-        status: bool = user.sign_in(name, password)
+        status: bool = user.sign_in(name, password, json.get("client_info") or {})
 
         if not status:
             emit('error', 'Invalid credentials or user not found.')
@@ -90,6 +101,38 @@ def login_user(json: JsonD):
         emit('error', 'Invalid JSON')
 
 
+@socketio.on('sessions_get')
+def handle_get_sessions(json: JsonD):
+    """List the devices signed in to the account.
+    {
+        "user_id": 1,
+        "token": "token123"
+    }
+    """
+
+    if not app_database.check_token(json["user_id"], json["token"]):
+        emit('error', 'Invalid token')
+        return
+
+    emit('sessions_list', app_database.get_sessions(json["user_id"]))
+
+
+@socketio.on('session_revoke')
+def handle_revoke_session(json: JsonD):
+    """Sign one device out, its token stops working.
+    {
+        "user_id": 1,
+        "token": "token123",
+        "session_id": "session_id"
+    }
+    """
+
+    if app_database.revoke_session(json["user_id"], json["token"], json["session_id"]):
+        emit('session_revoked', {'session_id': json["session_id"]})
+    else:
+        emit('error', 'Invalid token or session not found.')
+
+
 @socketio.on('disconnect')
 def test_disconnect():
     print('Client disconnected')
@@ -162,12 +205,13 @@ def create_chat(json: JsonD):
 
 @socketio.on('message_send')
 def send_message(json: JsonD):
-    """Store message in database.
+    """Store message in database. `attachments` is optional.
     {
         "chat_id": -1,
         "user_id": 1,
         "token": "token123",
-        "text": "Hello, World!"
+        "text": "Hello, World!",
+        "attachments": ["attachment_id"]
     """
 
     try:
@@ -175,14 +219,17 @@ def send_message(json: JsonD):
         user_id: int = json["user_id"]
         user_token: str = json["token"]
         text: str = json["text"]
+        attachments: list[str] = json.get("attachments", [])
 
         if not app_database.chat_exist(chat_id):
             emit('error', 'Chat not found.')
+            return
 
-        if user_id < 0 or not text:
+        if user_id < 0 or not (text or attachments):
             emit('error', 'Valid ID and text are required.')
+            return
 
-        message: str | JsonD = app_database.send_message(user_id, user_token, chat_id, text)
+        message: str | JsonD = app_database.send_message(user_id, user_token, chat_id, text, attachments)
 
         if isinstance(message, str):
             emit('error', message)
@@ -192,49 +239,204 @@ def send_message(json: JsonD):
         emit('error', 'Invalid JSON')
 
 
+@socketio.on('upload_chunk')
+def upload_chunk(json: JsonD):
+    """Write a chunk of an upload started with POST /api/uploads. `data` is a binary frame.
+    {
+        "upload_id": "upload_id",
+        "user_id": 1,
+        "token": "token123",
+        "offset": 0,
+        "data": b"..."
+    }
+    """
+
+    if not app_database.check_token(json["user_id"], json["token"]):
+        emit('error', 'Invalid token')
+        return
+
+    code, result = app_attachments.write_chunk(
+        json["upload_id"], json["user_id"], json["offset"], BytesIO(json["data"]).read
+    )
+    if isinstance(result, str):
+        emit('error', result)
+    else:
+        emit('upload_finished' if code == 201 else 'upload_progress', result)
+
+
 # region WEB INTERFACE
-@app.route('/', methods=['GET'])
+@web.route('/', methods=['GET'])
 def admin_page():
     return render_template('index.html')
 
 
-@app.route('/signin', methods=['GET'])
+@web.route('/signin', methods=['GET'])
 def signin_page():
     return render_template('login.html')
 
 
-@app.route('/api/v1', methods=['GET'])
+def _page() -> Tuple[int, int]:
+    "`start` and `count` query parameters. ValueError when they are negative, SQLite reads LIMIT -1 as no limit."
+
+    start, count = int(request.args["start"]), int(request.args["count"])
+    if start < 0 or count < 0:
+        raise ValueError("start and count can't be negative")
+    return start, count
+
+
+@web.route('/api/v1', methods=['GET'])
+@cached_response("messages", "users", "chats")
 def status():
     return {"message_count": app_database.count_messages(),
             "user_count": app_database.count_users(),
             "chat_count": app_database.count_chats()}
 
 
-@app.route('/api/messages', methods=['GET'])
+@web.route('/api/messages', methods=['GET'])
+@cached_response("messages")
 def get_messages():
     try:
-        return {"messages": app_database.get_messages(int(request.args["start"]), int(request.args["count"]))}
+        start, count = _page()
+        if count > get_settings().stream_threshold:
+            return stream_json('{"messages":[', app_database.iter_messages(start, count), ']}')
+        return {"messages": app_database.get_messages(start, count)}
     except (ValueError, IndexError):
         return {"error": "Invalid or missing start/count parameter"}
 
 
-@app.route('/api/chats', methods=['GET'])
+@web.route('/api/chats', methods=['GET'])
+@cached_response("chats")
 def get_chats():
     try:
-        return {"chats": app_database.get_chats(int(request.args["start"]), int(request.args["count"]))}
+        start, count = _page()
+        if count > get_settings().stream_threshold:
+            return stream_json('{"chats":{"chats":[', app_database.iter_chats(start, count), ']}}')
+        return {"chats": app_database.get_chats(start, count)}
     except (ValueError, IndexError):
         return {"error": "Invalid or missing start/count parameter"}
 
 
-@app.route('/api/users', methods=['GET'])
+@web.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload.
+    {
+        "user_id": 1,
+        "token": "token123",
+        "name": "cat.png",
+        "mime": "image/png",
+        "size": 12345
+    }
+    """
+
+    app_attachments.expire_uploads()
+
+    json: JsonD = request.get_json(silent=True) or {}
+    try:
+        size = int(json["size"])
+        if not 0 < size <= get_settings().max_upload_size:
+            return {"error": "Invalid upload size"}, 413
+
+        upload = app_database.create_upload(int(json["user_id"]), str(json["token"]), str(json.get("name", "")),
+                                            str(json.get("mime", "application/octet-stream")), size)
+    except (ValueError, KeyError):
+        return {"error": "Invalid or missing user_id/token/size"}, 400
+
+    if isinstance(upload, str):
+        return {"error": upload}, 403
+    return upload, 201
+
+
+@web.route('/api/uploads/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk_http(upload_id: str):
+    """GET returns how much was received so far, PUT appends the request body at `offset`.
+    Credentials go in the X-User-Id and X-Token headers.
+    """
+
+    try:
+        user_id = int(request.headers["X-User-Id"])
+    except (ValueError, KeyError):
+        return {"error": "Invalid or missing X-User-Id header"}, 400
+
+    upload = app_database.get_upload(upload_id)
+    if not upload or upload["user_id"] != user_id \
+            or not app_database.check_token(user_id, request.headers.get("X-Token", "")):
+        return {"error": "Upload not found"}, 404
+
+    if request.method == 'GET':
+        return {"upload_id": upload_id, "size": upload["size"], "received": upload["received"]}
+
+    try:
+        offset = int(request.args["offset"])
+    except (ValueError, KeyError):
+        return {"error": "Invalid or missing offset parameter"}, 400
+
+    code, result = app_attachments.write_chunk(upload_id, user_id, offset, request.stream.read)
+    if isinstance(result, str):
+        return {"error": result}, code
+    return result, code
+
+
+@web.route('/api/attachments/<attachment_id>', methods=['GET'])
+def get_attachment(attachment_id: str):
+    """Download an attachment. Credentials go in the X-User-Id and X-Token headers,
+    only the uploader and members of chats it was posted in can read it.
+    """
+
+    try:
+        user_id = int(request.headers["X-User-Id"])
+    except (ValueError, KeyError):
+        return {"error": "Invalid or missing X-User-Id header"}, 400
+
+    attachment = app_database.get_attachment(attachment_id)
+    if not attachment or not app_database.check_token(user_id, request.headers.get("X-Token", "")) \
+            or not app_database.can_read_attachment(user_id, attachment_id):
+        return {"error": "Attachment not found"}, 404
+
+    # conditional=True answers Range and If-None-Match, the file body goes out through wsgi.file_wrapper (sendfile).
+    response = send_file(app_attachments.blob_path(attachment["sha256"]), mimetype=attachment["mime"],
+                         download_name=attachment["name"] or None, etag=attachment["sha256"],
+                         conditional=True, max_age=31536000)
+    # Blobs never change, but shared caches must not hand them to other users.
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.vary.add('X-User-Id')
+    response.vary.add('X-Token')
+    return response
+
+
+@web.route('/api/users', methods=['GET'])
+@cached_response("users")
 def get_users():
     try:
-        return {"users": app_database.get_users(int(request.args["start"]), int(request.args["count"]))}
+        start, count = _page()
+        if count > get_settings().stream_threshold:
+            return stream_json('{"users":[', app_database.iter_users(start, count), ']}')
+        return {"users": app_database.get_users(start, count)}
     except (ValueError, IndexError):
         return {"error": "Invalid or missing start/count parameter"}
 # endregion
 
 
+def create_app(config: Optional[Settings | JsonD] = None) -> Flask:
+    """Build the Flask app. `config` replaces or overrides the settings read from RENALE_* environment variables.
+    The database is not touched here, it connects on the first query unless `prewarm` is set."""
+
+    settings = configure(config)
+    # Connections and cached responses made with other settings would point at the wrong files.
+    if app_database.connected_settings() not in (None, settings):
+        app_database.close_database()
+        clear_cache()
+
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = secret_key(settings)
+    app.register_blueprint(web)
+    socketio.init_app(app)
+
+    if settings.prewarm:
+        app_database.prewarm()
+    return app
+
+
 """
 async def route_request(route: str, method: str, body: str, headers: JsonD) -> str:
     response_data: JsonResp = {}
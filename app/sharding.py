@@ -0,0 +1,333 @@
+from sqlite3 import connect, Row, Connection
+from typing import Any, IO, Iterable, Iterator, List, Optional, Sequence, Tuple
+from itertools import islice
+from json import dumps, loads
+from argparse import ArgumentParser
+from threading import Lock, Thread
+from heapq import merge
+from pathlib import Path
+from zlib import crc32
+import fcntl
+import os
+
+from app.applib import JsonD, logf
+from app.config import get_settings
+
+
+__all__ = ["ShardSet", "shard_index", "shard_paths", "data_dir_lock", "pending_migration", "migrate"]
+
+
+# (user, chat, text, time, attachments as a JSON list of attachment ids)
+MessageRow = Tuple[int, int, str, float, str]
+
+SHARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    user INTEGER NOT NULL,
+    chat INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    time REAL NOT NULL,
+    attachments TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS messages_chat_time ON messages (chat, time);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+"""
+
+# Shared with prewarm() so the warmed statements are the ones sqlite3 finds in its statement cache later.
+INSERT_MESSAGE = "INSERT INTO messages (user, chat, text, time, attachments) VALUES (?, ?, ?, ?, ?)"
+SELECT_RECENT = "SELECT user, chat, text, time, attachments FROM messages ORDER BY time DESC LIMIT ?"
+SELECT_CHAT = "SELECT user, chat, text, time, attachments FROM messages WHERE chat =? ORDER BY time DESC LIMIT ? OFFSET ?"
+
+
+def shard_index(chat_id: int, count: int) -> int:
+    "Stable shard number for a chat. crc32 is used instead of hash() so every process agrees."
+
+    return crc32(str(chat_id).encode()) % count
+
+
+def shard_paths(count: int, directory: Path, suffix: str = "") -> List[Path]:
+    return [directory/f'server.messages-{i}.sqlite{suffix}' for i in range(count)]
+
+
+def _open(path: Path) -> Connection:
+    conn = connect(path, check_same_thread=False, cached_statements=get_settings().cached_statements)
+    conn.row_factory = Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SHARD_SCHEMA)
+    if 'attachments' not in _columns(conn):
+        conn.execute("ALTER TABLE messages ADD COLUMN attachments TEXT NOT NULL DEFAULT '[]'")
+        conn.commit()
+    return conn
+
+
+def _columns(conn: Connection) -> List[str]:
+    return [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+
+
+class ShardSet:
+    """Messages split over several SQLite files by chat_id.
+    Every shard has its own connection and writer lock, so writes to
+    different chats don't wait for each other.
+    """
+
+    def __init__(self, count: Optional[int] = None, directory: Optional[Path] = None, suffix: str = ""):
+        count = count or get_settings().message_shards
+        directory = directory or get_settings().data_dir
+        if count < 1:
+            raise ValueError("Shard count must be at least 1.")
+
+        existing = sorted(directory.glob(f'server.messages-*.sqlite{suffix}'))
+        if existing and len(existing) != count:
+            raise Exception(f"Found {len(existing)} message shards but {count} are configured, "
+                            f"run `python -m app.sharding migrate --shards {count}` first.")
+
+        self.count = count
+        self.paths = shard_paths(count, directory, suffix)
+        self.connections: List[Connection] = [_open(path) for path in self.paths]
+        self.locks: List[Lock] = [Lock() for _ in range(count)]
+
+    def for_chat(self, chat_id: int) -> Tuple[Connection, Lock]:
+        i = shard_index(chat_id, self.count)
+        return self.connections[i], self.locks[i]
+
+    # region WRITE
+    def insert(self, user_id: int, chat_id: int, text: str, time: float, attachments: Sequence[str] = ()) -> None:
+        conn, lock = self.for_chat(chat_id)
+        with lock:
+            conn.execute(INSERT_MESSAGE, (user_id, chat_id, text, time, dumps(list(attachments))))
+            conn.commit()
+
+    def insert_many(self, rows: Iterable[MessageRow]) -> int:
+        "Insert (user, chat, text, time, attachments) rows, grouped so every shard is written in one transaction."
+
+        grouped: List[List[MessageRow]] = [[] for _ in range(self.count)]
+        for row in rows:
+            grouped[shard_index(row[1], self.count)].append(row)
+
+        for conn, lock, batch in zip(self.connections, self.locks, grouped):
+            if not batch:
+                continue
+            with lock:
+                conn.executemany(INSERT_MESSAGE, batch)
+                conn.commit()
+        return sum(len(batch) for batch in grouped)
+
+    # endregion
+    # region READ
+    def recent(self, start: int = 0, count: int = 50) -> List[JsonD]:
+        return list(self.iter_recent(start, count))
+
+    def iter_recent(self, start: int = 0, count: int = 50) -> Iterator[JsonD]:
+        """Newest messages over all shards. Each shard yields its own top start+count rows
+        and the cursors are merged lazily, so only one row per shard is in memory at a time."""
+
+        cursors = [conn.execute(SELECT_RECENT, (start + count,)) for conn in self.connections]
+        rows = merge(*cursors, key=lambda row: row["time"], reverse=True)
+        for row in islice(rows, start, start + count):
+            yield _message_json(row)
+
+    def for_chat_messages(self, chat_id: int, start: int = 0, count: int = 50) -> List[JsonD]:
+        conn, _ = self.for_chat(chat_id)
+        rows = conn.execute(SELECT_CHAT, (chat_id, count, start)).fetchall()
+        return [_message_json(row) for row in rows]
+
+    def count_messages(self) -> int:
+        return sum(conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0] for conn in self.connections)
+
+    # endregion
+
+    def prewarm(self) -> None:
+        "Compile the read statements on every shard and pull their index pages into the page cache."
+
+        for conn in self.connections:
+            conn.execute(SELECT_RECENT, (1,)).fetchall()
+            conn.execute(SELECT_CHAT, (0, 1, 0)).fetchall()
+            conn.execute("SELECT COUNT(*) FROM messages").fetchone()
+
+    def close(self) -> None:
+        for conn in self.connections:
+            conn.close()
+
+
+def _message_json(row: Row) -> JsonD:
+    return {"chat": row["chat"],
+            "user": row["user"],
+            "text": row["text"],
+            "time": row["time"],
+            "attachments": loads(row["attachments"]),
+            }
+
+
+# region TOOLS
+def data_dir_lock(directory: Path, exclusive: bool = False) -> IO[str]:
+    """flock data_dir/server.lock and return the open file, closing it releases the lock.
+    Server processes hold it shared for as long as they are connected, offline tools
+    take it exclusively (`with data_dir_lock(d, exclusive=True):`) and fail right away while a server is up."""
+
+    f = open(directory/'server.lock', 'a')
+    try:
+        fcntl.flock(f, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        raise Exception(f"The server is running on {directory}, stop it first.") if exclusive \
+            else Exception(f"An offline tool is working on {directory}, wait for it to finish.")
+    return f
+
+
+def _marker(directory: Path) -> Path:
+    return directory/'server.messages.migrating'
+
+
+def _write_marker(directory: Path, state: JsonD) -> None:
+    tmp = directory/'server.messages.migrating.tmp'
+    tmp.write_text(dumps(state))
+    os.replace(tmp, _marker(directory))
+
+
+def pending_migration(directory: Path) -> bool:
+    "True if a migration copied its shards but was interrupted before swapping them in."
+
+    return _marker(directory).exists()
+
+
+def _finish_migration(directory: Path) -> None:
+    """Swap the finished .new shards in. Every step checks what is already done,
+    so after a crash it is simply run again. Old shards are kept as .old until all
+    new ones are in place."""
+
+    marker = _marker(directory)
+    state = loads(marker.read_text())
+
+    def advance(phase: str) -> None:
+        state["phase"] = phase
+        _write_marker(directory, state)
+
+    if state["phase"] == 'copied':
+        for name in state["old"]:
+            path, old = directory/name, directory/f'{name}.old'
+            if path.exists() and not old.exists():
+                path.rename(old)
+        advance('old_moved')
+
+    if state["phase"] == 'old_moved':
+        for path in shard_paths(state["count"], directory):
+            new = Path(f'{path}.new')
+            if new.exists():
+                new.rename(path)
+        advance('swapped')
+
+    global_db = connect(directory/'server.sqlite')
+    try:
+        if global_db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'").fetchone():
+            with global_db:
+                if state["keep_source"]:
+                    global_db.execute("CREATE TABLE IF NOT EXISTS messages_unsharded AS SELECT * FROM messages WHERE 0")
+                    global_db.execute("INSERT INTO messages_unsharded SELECT * FROM messages")
+                global_db.execute("DELETE FROM messages")
+    finally:
+        global_db.close()
+
+    for name in state["old"]:
+        Path(directory/f'{name}.old').unlink(missing_ok=True)
+    marker.unlink()
+
+
+def migrate(count: int, directory: Optional[Path] = None, keep_source: bool = False) -> int:
+    """Move messages into `count` shards. The server has to be stopped.
+    Rows come from the `messages` table of server.sqlite and from any existing shard
+    files, so the same command both splits the single file and rebalances shards.
+    New shards are written as .new files and swapped in once all of them are complete,
+    an interrupted swap is finished by the next run. `keep_source` moves the rows of
+    server.sqlite into messages_unsharded instead of deleting them.
+    """
+
+    directory = directory or get_settings().data_dir
+    with data_dir_lock(directory, exclusive=True):
+        if pending_migration(directory):
+            logf("Finishing an interrupted shard migration.", 1)
+            _finish_migration(directory)
+
+        # Without a marker the copy never completed, the originals are untouched.
+        for path in directory.glob('server.messages-*.sqlite.new*'):
+            path.unlink()
+
+        sources: List[Connection] = []
+        global_db = connect(directory/'server.sqlite')
+        if global_db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='messages'").fetchone():
+            sources.append(global_db)
+        old_paths = sorted(directory.glob('server.messages-*.sqlite'))
+        sources.extend(connect(path) for path in old_paths)
+
+        target = ShardSet(count, directory, suffix='.new')
+        moved = 0
+        try:
+            for source in sources:
+                attachments = "attachments" if 'attachments' in _columns(source) else "'[]'"
+                cursor = source.execute(f"SELECT user, chat, text, time, {attachments} FROM messages")
+                while batch := cursor.fetchmany(10_000):
+                    moved += target.insert_many(batch)
+        finally:
+            target.close()
+            global_db.close()
+            for source in sources:
+                source.close()
+
+        _write_marker(directory, {"phase": 'copied', "count": count, "keep_source": keep_source,
+                                  "old": [path.name for path in old_paths]})
+        _finish_migration(directory)
+
+    logf(f"Migrated {moved} messages into {count} shards.")
+    return moved
+
+
+def benchmark(max_shards: int, messages: int = 20_000, threads: int = 8) -> List[Tuple[int, float]]:
+    """Write `messages` rows from `threads` writers spread over many chats
+    for 1..max_shards shards and return (shards, messages per second) pairs."""
+
+    from tempfile import TemporaryDirectory
+    from time import perf_counter
+
+    results: List[Tuple[int, float]] = []
+    for count in range(1, max_shards + 1):
+        with TemporaryDirectory() as tmp:
+            shards = ShardSet(count, Path(tmp))
+            per_thread = messages // threads
+
+            def writer(n: int) -> None:
+                for i in range(per_thread):
+                    shards.insert(n, n * per_thread + i, "benchmark", float(i))
+
+            workers = [Thread(target=writer, args=(n,)) for n in range(threads)]
+            started = perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = perf_counter() - started
+            shards.close()
+        results.append((count, per_thread * threads / elapsed))
+    return results
+
+
+# endregion
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m app.sharding', description="Message shard tools.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate_cmd = commands.add_parser('migrate', help="Split server.sqlite messages or rebalance existing shards. Stop the server first.")
+    migrate_cmd.add_argument('--shards', type=int, default=get_settings().message_shards)
+    migrate_cmd.add_argument('--keep-source', action='store_true', help="Keep the rows of server.sqlite in messages_unsharded.")
+
+    bench_cmd = commands.add_parser('bench', help="Measure write throughput for 1..N shards.")
+    bench_cmd.add_argument('--shards', type=int, default=os.cpu_count() or 4)
+    bench_cmd.add_argument('--messages', type=int, default=20_000)
+    bench_cmd.add_argument('--threads', type=int, default=8)
+
+    args: Any = parser.parse_args()
+    if args.command == 'migrate':
+        print(f"Moved {migrate(args.shards, keep_source=args.keep_source)} messages into {args.shards} shards.")
+    else:
+        for shards, rate in benchmark(args.shards, args.messages, args.threads):
+            print(f"{shards:>3} shards: {rate:>10.0f} messages/s")
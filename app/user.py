@@ -1,10 +1,7 @@
 from platform import version, system, architecture, release
-from time import time as timestamp
-from typing import List
-import secrets
-import string
+from typing import List, Optional
 
-from app.applib import Json, JsonD, random_id
+from app.applib import Json, JsonD, random_id, random_token
 import app.database as app_database
 
 
@@ -42,12 +39,12 @@ class User:
         # IDK, but now it dont
         # WHY IS THIS ON THE SERVER SIDE AT ALL?
 
-        app_database.create_user(self._id, name, password, self.token, {str(int(timestamp())): session})
-        return True
+        self._id, self.token = app_database.create_user(self._id, name, password, self.token, session)
+        return self._id >= 0
 
-    def sign_in(self, name: str, password: str) -> bool:
+    def sign_in(self, name: str, password: str, client_info: Optional[Json] = None) -> bool:
         self.name = name
-        self._id, self.token = app_database.login_user(name, password)
+        self._id, self.token = app_database.login_user(name, password, client_info)
         return self._id >= 0
 
     def change_password(self, old_pass: str, new_pass: str) -> bool:
@@ -72,7 +69,7 @@ class User:
         return False
 
     def random_token(self):
-        return "".join(secrets.choice(string.ascii_letters + string.digits) for _ in range(128))
+        return random_token()
 
     def free_id(self) -> int:
         id = random_id()
@@ -0,0 +1,30 @@
+from typing import Iterator
+from sqlite3 import connect
+from pathlib import Path
+
+import pytest
+from flask import Flask
+
+from app.main import create_app
+import app.database as app_database
+
+
+# Tables the server expects to already exist in server.sqlite.
+LEGACY_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, password TEXT, token TEXT, sessions TEXT NOT NULL, chats TEXT);
+CREATE TABLE chats (is_group INTEGER, chat_id INTEGER, title TEXT, description TEXT, members TEXT, admins TEXT);
+"""
+
+
+@pytest.fixture
+def data_dir(tmp_path: Path) -> Path:
+    db = connect(tmp_path/'server.sqlite')
+    db.executescript(LEGACY_SCHEMA)
+    db.close()
+    return tmp_path
+
+
+@pytest.fixture
+def app(data_dir: Path) -> Iterator[Flask]:
+    yield create_app({"data_dir": data_dir, "message_shards": 2, "debug": False})
+    app_database.close_database()
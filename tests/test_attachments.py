@@ -0,0 +1,133 @@
+from typing import Any, List, Tuple
+from threading import Event, Thread
+from pathlib import Path
+from io import BytesIO
+
+from flask import Flask
+import pytest
+from flask.testing import FlaskClient
+
+from app.applib import JsonD
+from app.config import get_settings
+import app.attachments as app_attachments
+import app.database as app_database
+
+
+def user(id: int, name: str) -> Tuple[int, str]:
+    return app_database.create_user(id, name, "pw", f"token-{id}", {})
+
+
+def upload(client: FlaskClient, user_id: int, token: str, data: bytes) -> JsonD:
+    started = client.post('/api/uploads', json={"user_id": user_id, "token": token, "name": "a.txt",
+                                                "mime": "text/plain", "size": len(data)})
+    assert started.status_code == 201
+    finished = client.put(f'/api/uploads/{started.json["upload_id"]}?offset=0', data=data,
+                          headers={"X-User-Id": str(user_id), "X-Token": token})
+    assert finished.status_code == 201
+    return finished.json
+
+
+def download(client: FlaskClient, attachment_id: str, user_id: int, token: str):
+    return client.get(f'/api/attachments/{attachment_id}', headers={"X-User-Id": str(user_id), "X-Token": token})
+
+
+def test_only_chat_members_download(app: Flask):
+    client = app.test_client()
+    alice, alice_token = user(1, "alice")
+    bob, bob_token = user(2, "bob")
+    carol, carol_token = user(3, "carol")
+    chat = app_database.create_chat(alice, alice_token, True, "family", "", [bob])
+    attachment = upload(client, alice, alice_token, b"secret")["attachment_id"]
+
+    assert client.get(f'/api/attachments/{attachment}').status_code == 400
+    assert download(client, attachment, alice, "wrong").status_code == 404
+    assert download(client, attachment, bob, bob_token).status_code == 404
+
+    assert isinstance(app_database.send_message(alice, alice_token, chat, "file", [attachment]), dict)
+    response = download(client, attachment, bob, bob_token)
+    assert response.status_code == 200 and response.data == b"secret"
+    assert response.cache_control.private and not response.cache_control.public
+
+    # posting into the chat, or into one that doesn't exist, doesn't make carol a member
+    assert app_database.send_message(carol, carol_token, chat, "hi") == "Chat not found"
+    assert app_database.send_message(carol, carol_token, 5, "hi") == "Chat not found"
+    assert download(client, attachment, carol, carol_token).status_code == 404
+
+
+def test_private_chats_are_separate(app: Flask):
+    client = app.test_client()
+    alice, alice_token = user(1, "alice")
+    bob, bob_token = user(2, "bob")
+    carol, carol_token = user(3, "carol")
+    with_bob = app_database.create_chat(alice, alice_token, False, "", "", [bob])
+    with_carol = app_database.create_chat(alice, alice_token, False, "", "", [carol])
+    attachment = upload(client, alice, alice_token, b"for bob")["attachment_id"]
+
+    assert with_bob != with_carol
+    app_database.send_message(alice, alice_token, with_bob, "file", [attachment])
+    assert isinstance(app_database.send_message(carol, carol_token, with_carol, "hi"), dict)
+
+    assert download(client, attachment, bob, bob_token).status_code == 200
+    assert download(client, attachment, carol, carol_token).status_code == 404
+
+
+def test_send_only_own_or_chat_attachments(app: Flask):
+    client = app.test_client()
+    alice, alice_token = user(1, "alice")
+    bob, bob_token = user(2, "bob")
+    chat = app_database.create_chat(alice, alice_token, True, "family", "", [bob])
+    other = app_database.create_chat(bob, bob_token, True, "work", "", [])
+    attachment = upload(client, alice, alice_token, b"photo")["attachment_id"]
+
+    assert app_database.send_message(bob, bob_token, chat, "mine now", [attachment]) == "Attachment not found"
+
+    app_database.send_message(alice, alice_token, chat, "photo", [attachment])
+    assert isinstance(app_database.send_message(bob, bob_token, chat, "forward", [attachment]), dict)
+    assert app_database.send_message(bob, bob_token, other, "elsewhere", [attachment]) == "Attachment not found"
+
+
+def test_abandoned_uploads_expire(app: Flask):
+    client = app.test_client()
+    alice, alice_token = user(1, "alice")
+    upload_id = client.post('/api/uploads', json={"user_id": alice, "token": alice_token, "size": 10}).json["upload_id"]
+    client.put(f'/api/uploads/{upload_id}?offset=0', data=b"12345", headers={"X-User-Id": str(alice), "X-Token": alice_token})
+    assert app_attachments.part_path(upload_id).exists()
+
+    get_settings().upload_ttl = -1
+    assert app_attachments.expire_uploads(force=True) == 1
+
+    assert not app_attachments.part_path(upload_id).exists()
+    assert app_database.get_upload(upload_id) == {}
+    assert upload_id not in app_attachments._upload_locks
+
+
+def test_expiry_waits_for_a_final_chunk(app: Flask, monkeypatch: pytest.MonkeyPatch):
+    client = app.test_client()
+    alice, alice_token = user(1, "alice")
+    upload_id = client.post('/api/uploads', json={"user_id": alice, "token": alice_token, "size": 5}).json["upload_id"]
+
+    storing, release = Event(), Event()
+    store_blob = app_attachments.store_blob
+
+    def slow_store_blob(part: Path) -> str:
+        storing.set()
+        release.wait(5)
+        return store_blob(part)
+
+    monkeypatch.setattr(app_attachments, 'store_blob', slow_store_blob)
+    results: List[Tuple[int, Any]] = []
+    writer = Thread(target=lambda: results.append(app_attachments.write_chunk(upload_id, alice, 0, BytesIO(b"12345").read)))
+    writer.start()
+    assert storing.wait(5)
+
+    get_settings().upload_ttl = -1
+    expired: List[int] = []
+    expirer = Thread(target=lambda: expired.append(app_attachments.expire_uploads(force=True)))
+    expirer.start()
+    release.set()
+    writer.join()
+    expirer.join()
+
+    assert results[0][0] == 201
+    assert expired == [0]
+    assert app_database.get_attachment(results[0][1]["attachment_id"])
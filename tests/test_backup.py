@@ -0,0 +1,126 @@
+from threading import Event, Thread
+from sqlite3 import connect
+from pathlib import Path
+
+from flask import Flask
+import pytest
+
+from app.__main__ import serving_process
+from app.backup import benchmark, pending_restore, restore, snapshot
+from app.config import Settings
+import app.database as app_database
+
+
+def test_backup_does_not_stall_writers():
+    _, busy = benchmark(preload=200_000)
+    # the same copy in one step holds the connection, one insert waits for all of it
+    _, unthrottled = benchmark(pages=-1, pause=0, preload=200_000)
+
+    # longest insert in ms, the throttled copy lets writers in between steps of a few pages
+    assert busy[2] * 3 < unthrottled[2]
+
+
+def test_cli_snapshot_finishes_while_the_server_writes(app: Flask, data_dir: Path):
+    user_id, token = app_database.create_user(1, "alice", "pw", "token-1", {})
+    chats = [app_database.create_chat(user_id, token, True, f"chat {i}", "", []) for i in range(8)]
+    for i in range(2000):
+        app_database.send_message(user_id, token, chats[i % 8], f"message {i}")
+
+    done = Event()
+
+    def writer() -> None:
+        while not done.is_set():
+            app_database.send_message(user_id, token, chats[0], "busy")
+
+    thread = Thread(target=writer)
+    thread.start()
+    try:
+        result = snapshot(data_dir/'backups', data_dir=data_dir)
+    finally:
+        done.set()
+        thread.join()
+
+    assert sorted(path.name for path in result.iterdir()) == \
+        ['server.messages-0.sqlite', 'server.messages-1.sqlite', 'server.sqlite']
+    copied = sum(connect(path).execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+                 for path in result.glob('server.messages-*.sqlite'))
+    assert copied >= 2000
+
+
+def test_readers_dont_block_server_writes(app: Flask, data_dir: Path):
+    app_database.create_user(1, "alice", "pw", "token-1", {})
+
+    # what a one step snapshot of server.sqlite looks like to the server: a long read transaction
+    reader = connect(data_dir/'server.sqlite', timeout=0.1)
+    reader.execute("BEGIN")
+    reader.execute("SELECT COUNT(*) FROM users").fetchone()
+    try:
+        assert app_database.create_user(2, "bob", "pw", "token-2", {})[0] == 2
+        assert app_database.login_user("alice", "pw")[0] == 1
+    finally:
+        reader.close()
+
+
+def test_restore_refuses_while_the_server_runs(app: Flask, data_dir: Path):
+    app_database.get_database()
+    result = snapshot(data_dir/'backups', data_dir=data_dir)
+
+    with pytest.raises(Exception, match="stop it first"):
+        restore(result, data_dir)
+
+    app_database.close_database()
+    assert len(restore(result, data_dir)) == 3
+
+
+def test_scheduler_skips_the_reloader_watcher(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.delenv('WERKZEUG_RUN_MAIN', raising=False)
+    assert serving_process(Settings(debug=False))
+    assert not serving_process(Settings(debug=True))
+
+    monkeypatch.setenv('WERKZEUG_RUN_MAIN', 'true')
+    assert serving_process(Settings(debug=True))
+
+
+def test_interrupted_restore_is_finished_by_next_run(app: Flask, data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    user_id, token = app_database.create_user(1, "alice", "pw", "token-1", {})
+    chat = app_database.create_chat(user_id, token, True, "family", "", [])
+    for i in range(10):
+        app_database.send_message(user_id, token, chat, f"message {i}")
+    result = snapshot(data_dir/'backups', data_dir=data_dir)
+    app_database.create_user(2, "bob", "pw", "token-2", {})
+    app_database.send_message(user_id, token, chat, "after the snapshot")
+    app_database.close_database()
+
+    renames = 0
+    original = Path.rename
+
+    def crashing_rename(self: Path, target: Path) -> Path:
+        nonlocal renames
+        renames += 1
+        if renames == 3:
+            raise OSError("simulated crash")
+        return original(self, target)
+
+    monkeypatch.setattr(Path, 'rename', crashing_rename)
+    with pytest.raises(OSError):
+        restore(result, data_dir)
+    monkeypatch.setattr(Path, 'rename', original)
+
+    assert pending_restore(data_dir)
+    with pytest.raises(Exception, match="interrupted"):
+        app_database.init_database()
+
+    restore(result, data_dir)
+    assert not pending_restore(data_dir)
+    assert not list(data_dir.glob('*.old')) and not list(data_dir.glob('*.restore'))
+    assert app_database.count_users() == 1
+    assert app_database.count_messages() == 10
+
+
+def test_restore_refuses_during_a_migration(data_dir: Path):
+    (data_dir/'server.messages.migrating').write_text('{}')
+    (data_dir/'snapshot').mkdir()
+    connect(data_dir/'snapshot'/'server.sqlite').close()
+
+    with pytest.raises(Exception, match="migration was interrupted"):
+        restore(data_dir/'snapshot', data_dir)
@@ -0,0 +1,107 @@
+from typing import Iterator
+from sqlite3 import Cursor
+import gzip
+
+from flask import Flask
+from flask.testing import FlaskClient
+import pytest
+
+from app.applib import JsonD
+from app.config import get_settings
+import app.cache as app_cache
+import app.database as app_database
+
+
+@pytest.fixture
+def users(app: Flask) -> None:
+    for i in range(1, 101):
+        app_database.create_user(i, f"user number {i}", "pw", f"token-{i}", {})
+
+
+def test_gzip_follows_q_values(app: Flask, users: None):
+    client = app.test_client()
+
+    zipped = client.get('/api/users?start=0&count=100', headers={"Accept-Encoding": "gzip, deflate"})
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert len(gzip.decompress(zipped.data)) > 1024
+
+    refused = client.get('/api/users?start=0&count=100', headers={"Accept-Encoding": "gzip;q=0, deflate"})
+    assert "Content-Encoding" not in refused.headers
+    assert len(refused.json["users"]) == 100
+
+
+def test_failing_stream_is_cut_off(app: Flask, users: None, monkeypatch: pytest.MonkeyPatch):
+    @app_database.db_stream
+    def broken(sql: Cursor, start: int, count: int) -> Iterator[JsonD]:
+        yield from ({"id": i, "name": "user"} for i in range(start, start + 100))
+        raise Exception("disk I/O error")
+
+    monkeypatch.setattr(app_database, 'iter_users', broken)
+    get_settings().stream_threshold = 10
+
+    response = app.test_client().get('/api/users?start=0&count=1000')
+    with pytest.raises(Exception, match="disk I/O error"):
+        response.get_data()
+
+
+def etag(client: FlaskClient, path: str) -> str:
+    response = client.get(path)
+    assert response.status_code == 200
+    assert client.get(path, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    return response.headers["ETag"]
+
+
+@pytest.mark.parametrize("path", ['/api/users?start=0&count=10', '/api/v1'])
+def test_create_user_changes_the_etag(app: Flask, path: str):
+    client = app.test_client()
+    before = etag(client, path)
+
+    app_database.create_user(1, "alice", "pw", "token-1", {})
+
+    assert etag(client, path) != before
+
+
+@pytest.mark.parametrize("path", ['/api/chats?start=0&count=10', '/api/v1'])
+def test_create_chat_changes_the_etag(app: Flask, path: str):
+    client = app.test_client()
+    user_id, token = app_database.create_user(1, "alice", "pw", "token-1", {})
+    before = etag(client, path)
+
+    app_database.create_chat(user_id, token, True, "family", "", [])
+
+    assert etag(client, path) != before
+
+
+@pytest.mark.parametrize("path", ['/api/messages?start=0&count=10', '/api/v1'])
+def test_send_message_changes_the_etag(app: Flask, path: str):
+    client = app.test_client()
+    user_id, token = app_database.create_user(1, "alice", "pw", "token-1", {})
+    chat = app_database.create_chat(user_id, token, True, "family", "", [])
+    before = etag(client, path)
+
+    app_database.send_message(user_id, token, chat, "hello")
+
+    assert etag(client, path) != before
+    assert client.get(path, headers={"If-None-Match": before}).status_code == 200
+
+
+def test_big_pages_are_streamed_not_cached(app: Flask, users: None):
+    get_settings().stream_threshold = 10
+    app_cache.clear()
+
+    response = app.test_client().get('/api/users?start=0&count=50')
+
+    assert response.is_streamed
+    assert "ETag" not in response.headers
+    assert len(response.json["users"]) == 50
+    assert not app_cache._cache
+
+
+@pytest.mark.parametrize("path", ['/api/users', '/api/chats', '/api/messages'])
+@pytest.mark.parametrize("query", ['start=0&count=-1', 'start=-1&count=10'])
+def test_negative_page_is_rejected(app: Flask, users: None, path: str, query: str):
+    get_settings().stream_threshold = 10
+
+    response = app.test_client().get(f'{path}?{query}')
+
+    assert response.json == {"error": "Invalid or missing start/count parameter"}
@@ -0,0 +1,112 @@
+from sqlite3 import connect
+from pathlib import Path
+from json import dumps
+from time import sleep
+
+from flask import Flask
+import pytest
+
+from app.applib import JsonD
+from app.config import get_settings
+from app.main import create_app, socketio
+import app.database as app_database
+
+
+def register(app: Flask, name: str = "bob") -> JsonD:
+    client = socketio.test_client(app)
+    client.get_received()
+    client.emit('register', {"name": name, "password": "pw"})
+    event = client.get_received()[0]
+    assert event['name'] == 'registered'
+    return event['args'][0]
+
+
+def test_register_returns_session_token(app: Flask):
+    user = register(app)
+
+    assert app_database.check_token(user['user_id'], user['user_token'])
+    assert len(app_database.get_sessions(user['user_id'])) == 1
+
+
+def test_sessions_are_loaded_lazily(app: Flask):
+    user = register(app)
+
+    assert "sessions" not in app_database.get_user_by_id(user['user_id'])
+    assert len(app_database.get_user_by_id(user['user_id'], with_sessions=True)["sessions"]) == 1
+
+
+def test_revoke_one_device(app: Flask):
+    user = register(app)
+    _, phone_token = app_database.login_user("bob", "pw", {"device": "phone"})
+    phone = [s for s in app_database.get_sessions(user['user_id']) if s["client_info"] == {"device": "phone"}][0]
+
+    client = socketio.test_client(app)
+    client.get_received()
+    client.emit('session_revoke', {"user_id": user['user_id'], "token": user['user_token'], "session_id": phone["session_id"]})
+
+    assert client.get_received()[0]['name'] == 'session_revoked'
+    assert not app_database.check_token(user['user_id'], phone_token)
+    assert app_database.check_token(user['user_id'], user['user_token'])
+
+
+def test_last_seen_is_flushed_on_close(app: Flask, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(app_database, "LAST_SEEN_FLUSH_INTERVAL", 3600.0)
+    user = register(app)
+    session_id = app_database.get_sessions(user['user_id'])[0]["session_id"]
+    app_database.touch_session(session_id)
+    seen = app_database._last_seen_pending[session_id]
+
+    app_database.close_database()
+
+    assert app_database.get_sessions(user['user_id'])[0]["last_seen"] == seen
+
+
+def test_auth_stores_client_info(app: Flask):
+    user = register(app)
+
+    client = socketio.test_client(app)
+    client.get_received()
+    client.emit('auth', {"name": "bob", "password": "pw", "client_info": {"device": "phone"}})
+    assert client.get_received()[0]['name'] == 'success_auth'
+
+    assert [s["client_info"] for s in app_database.get_sessions(user['user_id'])][-1] == {"device": "phone"}
+
+
+def test_oldest_sessions_are_dropped(app: Flask):
+    get_settings().max_sessions = 3
+    user = register(app)
+    tokens = [app_database.login_user("bob", "pw", {"n": i})[1] for i in range(5)]
+
+    assert [s["client_info"] for s in app_database.get_sessions(user['user_id'])] == [{"n": 2}, {"n": 3}, {"n": 4}]
+    assert not app_database.check_token(user['user_id'], tokens[0])
+    assert app_database.check_token(user['user_id'], tokens[-1])
+
+
+def test_legacy_sessions_are_migrated(data_dir: Path):
+    db = connect(data_dir/'server.sqlite')
+    db.execute("INSERT INTO users VALUES (1, 'bob', 'pw', 'account-token', ?, '[]')",
+               (dumps([{"system": "Linux"}, {"system": "Windows"}]),))
+    db.commit()
+    db.close()
+
+    create_app({"data_dir": data_dir, "debug": False})
+    try:
+        assert [s["client_info"] for s in app_database.get_sessions(1)] == [{"system": "Linux"}, {"system": "Windows"}]
+        assert app_database.check_token(1, "account-token")
+        assert app_database.get_database().execute("SELECT sessions FROM users").fetchone()[0] == '[]'
+    finally:
+        app_database.close_database()
+
+
+def test_flusher_never_reconnects(app: Flask, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(app_database, "LAST_SEEN_FLUSH_INTERVAL", 0.01)
+    register(app)
+    app_database.close_database()
+
+    # a flusher that woke up just as the database was closed
+    stop = app_database._start_last_seen_flusher()
+    monkeypatch.setitem(app_database._last_seen_pending, "session", 1.0)
+    sleep(0.1)
+    stop.set()
+
+    assert app_database.connected_settings() is None
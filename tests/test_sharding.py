@@ -0,0 +1,99 @@
+from sqlite3 import connect
+from pathlib import Path
+
+from flask import Flask
+import pytest
+
+from app.main import create_app
+from app.sharding import migrate, pending_migration, shard_index
+import app.database as app_database
+
+
+def seed_legacy_messages(data_dir: Path, count: int = 100) -> None:
+    db = connect(data_dir/'server.sqlite')
+    db.execute("CREATE TABLE messages (user INTEGER, chat INTEGER, text TEXT, time REAL)")
+    db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?)", [(1, i % 7, f'm{i}', float(i)) for i in range(count)])
+    db.commit()
+    db.close()
+
+
+def test_messages_are_routed_by_chat(app: Flask):
+    shards = app_database.get_message_shards()
+    for chat in range(10):
+        shards.insert(1, chat, "hi", float(chat))
+
+    for chat in range(10):
+        conn, _ = shards.for_chat(chat)
+        assert conn is shards.connections[shard_index(chat, 2)]
+        assert len(shards.for_chat_messages(chat)) == 1
+    assert [m["time"] for m in app_database.get_messages(0, 3)] == [9.0, 8.0, 7.0]
+
+
+def test_legacy_rows_block_startup(data_dir: Path):
+    seed_legacy_messages(data_dir)
+    create_app({"data_dir": data_dir, "message_shards": 2})
+
+    with pytest.raises(Exception, match="still holds messages"):
+        app_database.init_database()
+
+    migrate(2, data_dir)
+    assert app_database.count_messages() == 100
+    app_database.close_database()
+
+
+def test_migrate_refuses_while_server_runs(app: Flask, data_dir: Path):
+    app_database.count_messages()
+
+    with pytest.raises(Exception, match="stop it first"):
+        migrate(3, data_dir)
+
+
+def test_rebalance_keeps_every_message(data_dir: Path):
+    seed_legacy_messages(data_dir)
+    migrate(2, data_dir)
+    migrate(5, data_dir)
+
+    create_app({"data_dir": data_dir, "message_shards": 5})
+    assert app_database.count_messages() == 100
+    assert sorted(m["text"] for m in app_database.get_messages(0, 100)) == sorted(f'm{i}' for i in range(100))
+    app_database.close_database()
+
+
+def test_interrupted_swap_is_finished_by_next_run(data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    seed_legacy_messages(data_dir)
+    migrate(2, data_dir)
+
+    renames = 0
+    original = Path.rename
+
+    def crashing_rename(self: Path, target: Path) -> Path:
+        nonlocal renames
+        renames += 1
+        if renames == 3:
+            raise OSError("simulated crash")
+        return original(self, target)
+
+    monkeypatch.setattr(Path, 'rename', crashing_rename)
+    with pytest.raises(OSError):
+        migrate(3, data_dir)
+    monkeypatch.setattr(Path, 'rename', original)
+
+    assert pending_migration(data_dir)
+    create_app({"data_dir": data_dir, "message_shards": 3})
+    with pytest.raises(Exception, match="interrupted"):
+        app_database.init_database()
+
+    migrate(3, data_dir)
+    assert not pending_migration(data_dir)
+    assert app_database.count_messages() == 100
+    app_database.close_database()
+
+
+def test_keep_source_moves_rows_aside(data_dir: Path):
+    seed_legacy_messages(data_dir)
+    migrate(2, data_dir, keep_source=True)
+
+    db = connect(data_dir/'server.sqlite')
+    assert db.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 0
+    assert db.execute("SELECT COUNT(*) FROM messages_unsharded").fetchone()[0] == 100
+    db.close()
@@ -0,0 +1,64 @@
+from statistics import median
+from pathlib import Path
+import subprocess
+import sys
+import os
+
+from flask import Flask
+import pytest
+
+from app.__main__ import benchmark_startup
+from app.main import create_app
+import app.database as app_database
+
+
+# Loose on purpose, it only has to catch something like a connect or a heavy import creeping back in.
+STARTUP_BUDGET: float = 5.0
+
+
+def test_import_does_not_connect(data_dir: Path):
+    probe = "import app.main, app.database as d; print(d.connected_settings() is None)"
+    result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True,
+                            env={**os.environ, "RENALE_DATA_DIR": str(data_dir)})
+
+    assert result.stdout.split()[-1] == 'True'
+
+
+def test_startup_time(data_dir: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setenv("RENALE_DATA_DIR", str(data_dir))
+    timings = benchmark_startup(runs=3)
+
+    assert median(timings) < STARTUP_BUDGET
+
+
+def test_create_app_does_not_connect(data_dir: Path):
+    app_database.close_database()
+    create_app({"data_dir": data_dir})
+
+    assert app_database.connected_settings() is None
+
+
+def test_create_app_switches_database(app: Flask, data_dir: Path, tmp_path_factory: pytest.TempPathFactory):
+    app_database.count_users()
+    assert app_database.connected_settings().data_dir == data_dir  # type: ignore
+
+    other = tmp_path_factory.mktemp('other')
+    create_app({"data_dir": other, "message_shards": 2})
+    app_database.count_users()
+
+    assert app_database.connected_settings().data_dir == other  # type: ignore
+    assert (other/'server.sqlite').exists()
+
+
+def test_secret_key_is_shared(data_dir: Path):
+    first = create_app({"data_dir": data_dir})
+    second = create_app({"data_dir": data_dir})
+
+    assert first.config['SECRET_KEY'] == second.config['SECRET_KEY']
+    assert (data_dir/'.secret_key').exists()
+
+
+def test_log_is_written_to_the_data_dir(app: Flask, data_dir: Path):
+    app_database.count_users()
+
+    assert "Connected to" in (data_dir/'log.txt').read_text()